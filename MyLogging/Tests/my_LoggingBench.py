@@ -0,0 +1,383 @@
+"""
+Throughput and latency benchmarks for MyloLogging pipelines.
+
+Every configuration is built from MyloLogging.build_logging() and run in a
+fresh process, so peak RSS belongs to that configuration alone. Producer
+threads log a pre-generated message mix; the time of each logging call is
+its enqueue latency (for direct handlers, the whole emit). Throughput is
+measured until the pipeline has drained: listeners stopped, socket
+receivers holding every record.
+
+	python Tests/my_LoggingBench.py --producers 1,4 --mix args,mixed --output bench.json
+	python Tests/my_LoggingBench.py --config queue,socket --baseline bench.json
+"""
+import argparse
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import buildLog as mlog
+import my_Loggin as mylog
+
+FILE_HANDLERS = ('watchFile', 'rotatehand', 'mainfilehand', 'secondfilehand', 'userfilehand', 'segmenthand')
+CONFIGS = tuple('direct:' + name for name in FILE_HANDLERS) + ('queue', 'fanout', 'socket', 'batchsocket')
+
+LEVELS = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)
+
+try:
+	1 / 0
+except ZeroDivisionError:
+	EXC_INFO = sys.exc_info()
+
+
+def plain_message(rng, i):
+	return logging.INFO, 'A plain message with no arguments', (), None
+
+
+def args_message(rng, i):
+	return logging.INFO, 'A message at %s level with %d %s', ('INFO', i, 'parameters'), None
+
+
+def levels_message(rng, i):
+	lvl = rng.choice(LEVELS)
+	return lvl, 'A message at %s level with %d %s', (logging.getLevelName(lvl), i, 'parameters'), None
+
+
+def large_message(rng, i):
+	return logging.INFO, 'payload %d %s', (i, 'x' * 4096), None
+
+
+def exception_message(rng, i):
+	return logging.ERROR, 'failed on %d', (i,), EXC_INFO
+
+
+# name: [(weight, message maker), ...]
+MIXES = {
+	'plain' : [(1, plain_message)],
+	'args'  : [(1, args_message)],
+	'levels': [(1, levels_message)],
+	'large' : [(1, large_message)],
+	'mixed' : [(70, args_message), (20, levels_message), (8, large_message), (2, exception_message)],
+}
+
+
+def make_plan(mix, count, seed):
+	rng = random.Random(seed)
+	weights, makers = zip(*((weight, maker) for weight, maker in MIXES[mix]))
+	return [maker(rng, i) for i, maker in enumerate(rng.choices(makers, weights, k=count))]
+
+
+class CountingHandler(logging.Handler):
+	"""
+	Counts the records a socket receiver delivers and wakes the benchmark
+	once it has them all.
+	"""
+
+	def __init__(self, expected):
+		logging.Handler.__init__(self)
+		self.expected = expected
+		self.count = 0
+		self.done = threading.Event()
+
+	def emit(self, record):
+		self.count += 1
+		if self.count >= self.expected:
+			self.done.set()
+
+
+class Pipeline(object):
+	"""
+	A logger wired to one configuration, with what it takes to drain it.
+	"""
+
+	def __init__(self, mlp, logger):
+		self.mlp = mlp
+		self.logger = logger
+		self.handlers = []
+		self.listener = None
+		self.receiver = None
+		self.counter = None
+		self.thread = None
+
+	def add(self, handler):
+		self.handlers.append(handler)
+		self.logger.addHandler(handler)
+
+	def drain(self, timeout):
+		"""
+		Wait until every record logged so far has been delivered.
+		"""
+		for handler in self.handlers:
+			handler.flush()
+		if self.listener is not None:
+			self.listener.stop()
+			self.listener = None
+		if self.counter is not None:
+			self.counter.done.wait(timeout)
+		for handler in self.mlp.handlers.values():
+			handler.flush()
+
+	def close(self):
+		for handler in self.handlers:
+			self.logger.removeHandler(handler)
+		if self.receiver is not None:
+			self.receiver.stop_asyncio()
+			self.thread.join(5)
+			self.receiver.server_close()
+		for handler in self.mlp.handlers.values():
+			handler.close()
+
+
+def build_pipeline(config, expected):
+	mlp = mlog.MyloLogging()
+	mlp.build_logging()
+	logger = logging.getLogger('bench')
+	logger.setLevel(logging.DEBUG)
+	logger.propagate = False
+	pipe = Pipeline(mlp, logger)
+	if config.startswith('direct:'):
+		pipe.add(mlp.handlers[config.split(':', 1)[1]])
+	elif config in ('queue', 'fanout'):
+		que = mlp.makeQueue()
+		if config == 'queue':
+			pipe.listener = mylog.CustomQueueListener(que, mlp.handlers['mainfilehand'])
+		else:
+			pipe.listener = mylog.FanOutQueueListener(que, *[mlp.handlers[name] for name in FILE_HANDLERS])
+		pipe.listener.start()
+		pipe.add(mylog.CustomQueueHandler(que))
+	elif config in ('socket', 'batchsocket'):
+		receiver = pipe.receiver = mylog.LogRecordSocketReceiver(port=0)
+		receiver.logname = 'bench.received'
+		received = logging.getLogger(receiver.logname)
+		received.propagate = False
+		pipe.counter = CountingHandler(expected)
+		received.addHandler(pipe.counter)
+		pipe.thread = threading.Thread(target=receiver.serve_asyncio, name='bench_receiver')
+		pipe.thread.daemon = True
+		pipe.thread.start()
+		port = receiver.server_address[1]
+		if config == 'socket':
+			pipe.add(logging.handlers.SocketHandler('localhost', port))
+		else:
+			pipe.add(mylog.BatchingSocketHandler('localhost', port))
+	else:
+		raise ValueError('unknown configuration %r' % config)
+	return pipe
+
+
+def produce(logger, plan, latencies, barrier):
+	log = logger.log
+	clock = time.perf_counter_ns
+	barrier.wait()
+	for i, (lvl, msg, args, exc_info) in enumerate(plan):
+		start = clock()
+		log(lvl, msg, *args, exc_info=exc_info)
+		latencies[i] = clock() - start
+
+
+def percentile(ordered, fraction):
+	if not ordered:
+		return 0
+	return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_kb():
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is in bytes on macOS and kilobytes elsewhere
+	return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_one(spec):
+	"""
+	Run a single configuration and return its result. Runs in its own
+	process and working directory.
+	"""
+	os.chdir(spec['directory'])
+	# Keep the root logger off MyloLogging's temp.log; it is not under test.
+	logging.basicConfig(handlers=[logging.NullHandler()])
+	producers = spec['producers']
+	records = spec['records']
+	plans = [make_plan(spec['mix'], records, spec['seed'] + n) for n in range(producers)]
+	pipe = build_pipeline(spec['config'], producers * records)
+	latencies = [array('q', bytes(8 * records)) for n in range(producers)]
+	barrier = threading.Barrier(producers + 1)
+	threads = [threading.Thread(target=produce, args=(pipe.logger, plans[n], latencies[n], barrier),
+	                            name='producer%d' % n) for n in range(producers)]
+	for thread in threads:
+		thread.start()
+	barrier.wait()
+	start = time.perf_counter()
+	for thread in threads:
+		thread.join()
+	produced = time.perf_counter()
+	pipe.drain(spec['timeout'])
+	finished = time.perf_counter()
+	received = pipe.counter.count if pipe.counter is not None else None
+	pipe.close()
+
+	ordered = sorted(value for lat in latencies for value in lat)
+	total = producers * records
+	return {
+		'config'          : spec['config'],
+		'mix'             : spec['mix'],
+		'producers'       : producers,
+		'records'         : total,
+		'received'        : received,
+		'seconds'         : finished - start,
+		'produce_seconds' : produced - start,
+		'records_per_sec' : total / (finished - start),
+		'produce_per_sec' : total / (produced - start),
+		'latency_ns'      : {
+			'p50' : percentile(ordered, 0.50),
+			'p99' : percentile(ordered, 0.99),
+			'p999': percentile(ordered, 0.999),
+			'max' : ordered[-1] if ordered else 0,
+			'mean': sum(ordered) / len(ordered) if ordered else 0,
+		},
+		'peak_rss_kb'     : peak_rss_kb(),
+	}
+
+
+def _child(spec, conn):
+	try:
+		conn.send(run_one(spec))
+	except BaseException as e:
+		conn.send({'config': spec['config'], 'mix': spec['mix'], 'producers': spec['producers'],
+		           'error': '%s: %s' % (type(e).__name__, e)})
+	finally:
+		conn.close()
+
+
+def run_isolated(spec):
+	ctx = multiprocessing.get_context('spawn')
+	parent, child = ctx.Pipe(duplex=False)
+	proc = ctx.Process(target=_child, args=(spec, child), name='bench')
+	proc.start()
+	child.close()
+	try:
+		result = parent.recv()
+	except EOFError:
+		result = {'config': spec['config'], 'mix': spec['mix'], 'producers': spec['producers'],
+		          'error': 'benchmark process exited with code %s' % proc.exitcode}
+	proc.join()
+	return result
+
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+		                               stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def result_key(result):
+	return result['config'], result['mix'], result['producers']
+
+
+def report(results, baseline=None):
+	base = {}
+	if baseline:
+		base = {result_key(result): result for result in baseline['results'] if 'error' not in result}
+	header = '%-24s %-7s %4s %12s %10s %10s %10s %9s' % (
+		'config', 'mix', 'prod', 'records/s', 'p50 us', 'p99 us', 'p999 us', 'rss MB')
+	if base:
+		header += ' %8s %8s' % ('rate x', 'p99 x')
+	print(header)
+	for result in results:
+		if 'error' in result:
+			print('%-24s %-7s %4s  error: %s' % (result['config'], result['mix'], result['producers'], result['error']))
+			continue
+		latency = result['latency_ns']
+		line = '%-24s %-7s %4d %12.0f %10.1f %10.1f %10.1f %9.1f' % (
+			result['config'], result['mix'], result['producers'], result['records_per_sec'],
+			latency['p50'] / 1e3, latency['p99'] / 1e3, latency['p999'] / 1e3, result['peak_rss_kb'] / 1024)
+		old = base.get(result_key(result))
+		if old is not None:
+			line += ' %8.2f %8.2f' % (result['records_per_sec'] / old['records_per_sec'],
+			                          latency['p99'] / max(old['latency_ns']['p99'], 1))
+		if result['received'] is not None and result['received'] != result['records']:
+			line += '  received %d' % result['received']
+		print(line)
+
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--config', default=','.join(CONFIGS),
+	                    help='comma separated configurations (default: all of %s)' % ', '.join(CONFIGS))
+	parser.add_argument('--producers', default='1,4', help='comma separated producer thread counts')
+	parser.add_argument('--mix', default='args,mixed',
+	                    help='comma separated message mixes from %s' % ', '.join(sorted(MIXES)))
+	parser.add_argument('--records', type=int, default=20000, help='records per producer')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for socket delivery')
+	parser.add_argument('--output', help='write JSON results to this file')
+	parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+	parser.add_argument('--keep', action='store_true', help='keep the log files written by each run')
+	return parser.parse_args(argv)
+
+
+def main(argv=None):
+	args = parse_args(argv)
+	configs = [config for config in args.config.split(',') if config]
+	mixes = [mix for mix in args.mix.split(',') if mix]
+	for config in configs:
+		if config not in CONFIGS:
+			raise SystemExit('unknown configuration %r' % config)
+	for mix in mixes:
+		if mix not in MIXES:
+			raise SystemExit('unknown message mix %r' % mix)
+	baseline = None
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+
+	results = []
+	for config in configs:
+		for mix in mixes:
+			for producers in [int(n) for n in args.producers.split(',') if n]:
+				directory = tempfile.mkdtemp(prefix='mylobench-')
+				try:
+					results.append(run_isolated({
+						'config'   : config,
+						'mix'      : mix,
+						'producers': producers,
+						'records'  : args.records,
+						'seed'     : args.seed,
+						'timeout'  : args.timeout,
+						'directory': directory,
+					}))
+				finally:
+					if not args.keep:
+						shutil.rmtree(directory, ignore_errors=True)
+
+	report(results, baseline)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({
+				'commit'   : git_commit(),
+				'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+				'python'   : platform.python_version(),
+				'platform' : platform.platform(),
+				'cpus'     : os.cpu_count(),
+				'args'     : vars(args),
+				'results'  : results,
+			}, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
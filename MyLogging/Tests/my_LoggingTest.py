@@ -7,7 +7,7 @@ import logging_tree
 
 import buildLog as mlog
 import eValuation as eVal
-from my_Loggin import ContextFilter, CustomAdapter, LogRecordSocketReceiver, LoggingContext, StyleAdapter
+from my_Loggin import CustomAdapter, LogRecordSocketReceiver, LoggingContext, StyleAdapter
 
 USERS = ['jim', 'fred', 'sheila']
 IPS = ['123.231.231.123', '127.0.0.1', '192.168.0.1']
@@ -19,8 +19,6 @@ levels = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.C
 
 mlp = mlog.MyloLogging()
 
-f = ContextFilter(choice(USERS), choice(IPS), choice(HOSTS))
-
 mlp.build_logging()
 mlp.buildQueue()
 
@@ -89,7 +87,8 @@ mlp.loggers['secondaryLog'].removeHandler(newhandler)
 newhandler = mlp.handlers['userfilehand']
 mlp.loggers['usersLog'].addHandler(newhandler)
 mlp.loggers['usersLog'].setLevel(logging.DEBUG)
-mlp.loggers['usersLog'].addFilter(f)
+mlp.context.install()
+mlp.context.set(user=choice(USERS), ip=choice(IPS), host=choice(HOSTS))
 
 mlp.loggers['usersLog'].debug('a debug message with user info')
 
@@ -1,8 +1,8 @@
+import copy
 import logging
-import logging.config
 import logging.handlers
 import os
-from logging.config import dictConfig, fileConfig
+import threading
 
 import my_Loggin as mylog
 
@@ -14,7 +14,7 @@ except ImportError:
 
 class MyloLogging:
 
-	def __init__(self):
+	def __init__(self, maxsize=-1, maxbytes=0, overflow='drop_oldest', lazy=False):
 		# print("Logging tree at init")
 		# logging_tree.printout(node=None)
 		# logging.info("Loading basic configuration")
@@ -23,14 +23,22 @@ class MyloLogging:
 		                    datefmt='%m-%d %H:%M',
 		                    filename='/var/log/mylo/temp.log',
 		                    filemode='w')
-		logging.info("Setting queue size to no limit")
-		self.que = queue.Queue(-1)  # no limit on size
+		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.overflow = overflow
+		# Create handlers on their first record instead of in build_logging
+		self.lazy = lazy
+		self.que = self.makeQueue()
 		logging.info("Compiling list")
 		self.loggers = {}
 		self.handlers = {}
 		self.formatters = {}
 		self.listeners = {}
+		self.filters = {}
 		self.titles = {}
+		# The config last applied by build_from_dict / build_from_ini
+		self.live_config = None
+		self.context = mylog.LogContext()
 
 		self.myloging_dict = dict(
 			version=1,
@@ -46,24 +54,298 @@ class MyloLogging:
 			root={},
 		)
 
-	def build_from_ini(self, iniFile):
-		fileConfig(iniFile)
+	# Seconds replaced handlers stay open for records already routed to them
+	reload_grace = 1.0
 
-	def build_from_dict(self, configDict='default'):
+	def build_from_ini(self, iniFile, reload=False):
+		from logging.config import fileConfig
+		parser = self.read_ini(iniFile)
+		config = self.ini_to_dict(parser)
+		if reload:
+			return self.reload_config(config)
+		fileConfig(parser)
+		self.capture_config(config)
+
+	def build_from_dict(self, configDict='default', reload=False):
+		from logging.config import dictConfig
 		if configDict == 'default':
 			configDict = self.myloging_dict
+		if reload:
+			return self.reload_config(configDict)
+		# dictConfig replaces the specs in configDict with the objects it makes
+		config = copy.deepcopy(configDict)
 		dictConfig(configDict)
+		self.capture_config(config)
+
+	def capture_config(self, config):
+		# Record the objects a full dictConfig / fileConfig made, by config name
+		self.live_config = config
+		for name in config.get('handlers', {}):
+			hand = logging._handlers.get(name)
+			if hand is not None:
+				self.handlers[name] = hand
+		for name, spec in config.get('handlers', {}).items():
+			hand = self.handlers.get(name)
+			if hand is None:
+				continue
+			if spec.get('formatter') and hand.formatter is not None:
+				self.formatters[spec['formatter']] = hand.formatter
+			for fname, filt in zip(spec.get('filters', ()), hand.filters):
+				self.filters[fname] = filt
+		for name in config.get('loggers', {}):
+			self.loggers[name] = logging.getLogger(name)
+
+	def reload_config(self, config):
+		"""
+		Apply a dictConfig style config by changing only what differs from
+		the live one. New formatters, filters and handlers are all built
+		before anything is swapped; swaps are single assignments of handler
+		lists and listener dispatch tables, so records keep flowing through
+		a running thread listener. A handler whose level, formatter or
+		filters changed is updated in place; one whose other settings changed
+		is replaced and closed after reload_grace seconds.
+		"""
+		from logging.config import DictConfigurator
+		live = self.live_config or {}
+		new = copy.deepcopy(config)
+		conf = DictConfigurator(copy.deepcopy(config))
+		cfg = conf.config
+
+		def changed(section, name, built):
+			return name not in built or live.get(section, {}).get(name) != new[section][name]
+
+		formatters = {}
+		for name in new.get('formatters', {}):
+			if changed('formatters', name, self.formatters):
+				formatters[name] = conf.configure_formatter(cfg['formatters'][name])
+			else:
+				formatters[name] = self.formatters[name]
+			cfg['formatters'][name] = formatters[name]
+		filters = {}
+		for name in new.get('filters', {}):
+			if changed('filters', name, self.filters):
+				filters[name] = conf.configure_filter(cfg['filters'][name])
+			else:
+				filters[name] = self.filters[name]
+			cfg['filters'][name] = filters[name]
+
+		# Handlers with a target come after the handlers they target
+		specs = new.get('handlers', {})
+		order = sorted(specs, key=lambda name: 'target' in specs[name])
+		handlers = {}
+		replaced = {}
+		levels = {}
+		for name in order:
+			spec = specs[name]
+			old = self.handlers.get(name)
+			old_spec = live.get('handlers', {}).get(name)
+			shape = dict((k, v) for k, v in spec.items() if k not in ('level', 'formatter', 'filters'))
+			old_shape = dict((k, v) for k, v in (old_spec or {}).items()
+			                 if k not in ('level', 'formatter', 'filters'))
+			if old is None or old_spec is None or shape != old_shape or handlers.get(spec.get('target')) in replaced.values():
+				hand = conf.configure_handler(cfg['handlers'][name])
+				hand.name = name
+				if callable(spec.get('()')) and spec.get('target'):
+					hand.setTarget(handlers[spec['target']])
+				if old is not None:
+					replaced[old] = hand
+			else:
+				hand = old
+				level = logging._checkLevel(spec.get('level', logging.NOTSET))
+				if hand.level != level:
+					levels[hand] = level
+				formatter = formatters.get(spec.get('formatter'))
+				if hand.formatter is not formatter:
+					hand.setFormatter(formatter)
+				hand_filters = [filters[f] for f in spec.get('filters', ())]
+				if hand.filters != hand_filters:
+					hand.filters = hand_filters
+			handlers[name] = cfg['handlers'][name] = hand
+		for name in live.get('handlers', {}):
+			if name not in specs and name in self.handlers:
+				replaced[self.handlers.pop(name)] = None
+
+		# Swap handlers everywhere they are attached, then configure loggers
+		if replaced:
+			manager = logging.Logger.manager
+			for logger in [logging.root] + list(manager.loggerDict.values()):
+				if isinstance(logger, logging.Logger) and any(h in replaced for h in logger.handlers):
+					logger.handlers = [replaced.get(h, h) for h in logger.handlers if replaced.get(h, h) is not None]
+			for listener in self.listeners.values():
+				listener.replaceHandlers(replaced)
+		# Listener dispatch tables are keyed on handler levels, so a level
+		# changed in place has to go through the listeners as well.
+		for hand, level in levels.items():
+			hand.setLevel(level)
+			for listener in self.listeners.values():
+				listener.setHandlerLevel(hand, level)
+		loggers = dict(new.get('loggers', {}))
+		if 'root' in new:
+			loggers[''] = new['root']
+		live_loggers = dict(live.get('loggers', {}))
+		if 'root' in live:
+			live_loggers[''] = live['root']
+		for name, spec in loggers.items():
+			if live_loggers.get(name) == spec and name in self.loggers:
+				continue
+			logger = self.loggers[name] = logging.getLogger(name or None)
+			if 'level' in spec:
+				logger.setLevel(logging._checkLevel(spec['level']))
+			if name:
+				logger.propagate = spec.get('propagate', True)
+			logger.handlers = [handlers[h] for h in spec.get('handlers', ())]
+			logger.filters = [filters[f] for f in spec.get('filters', ())]
+			logger.disabled = False
+		for name in live_loggers:
+			if name not in loggers:
+				logger = logging.getLogger(name or None)
+				logger.handlers = [h for h in logger.handlers if h not in handlers.values()]
+				logger.setLevel(logging.WARNING if not name else logging.NOTSET)
+				logger.propagate = True
+
+		self.formatters.update(formatters)
+		self.filters.update(filters)
+		self.handlers.update(handlers)
+		self.live_config = new
+		retired = [hand for hand in replaced if hand not in handlers.values()]
+		if retired:
+			closer = threading.Timer(self.reload_grace, lambda: [hand.close() for hand in retired])
+			closer.daemon = True
+			closer.start()
+		return replaced
+
+	@staticmethod
+	def read_ini(iniFile):
+		import configparser
+		if isinstance(iniFile, configparser.RawConfigParser):
+			return iniFile
+		parser = configparser.ConfigParser()
+		if hasattr(iniFile, 'readline'):
+			parser.read_file(iniFile)
+		else:
+			parser.read(iniFile)
+		return parser
+
+	def ini_to_dict(self, iniFile):
+		# Translate a fileConfig ini into the equivalent dictConfig dict
+		parser = self.read_ini(iniFile)
+
+		def names(section):
+			return [n.strip() for n in parser.get(section, 'keys', fallback='').split(',') if n.strip()]
+
+		def handler_names(section):
+			return [n.strip() for n in parser.get(section, 'handlers', fallback='').split(',') if n.strip()]
+
+		config = {'version': 1, 'formatters': {}, 'handlers': {}, 'loggers': {}}
+		for name in names('formatters'):
+			section = 'formatter_%s' % name
+			spec = config['formatters'][name] = {
+				'format' : parser.get(section, 'format', raw=True, fallback=None),
+				'datefmt': parser.get(section, 'datefmt', raw=True, fallback=None),
+				'style'  : parser.get(section, 'style', raw=True, fallback='%'),
+			}
+			if parser.has_option(section, 'class'):
+				spec['class'] = parser.get(section, 'class')
+		for name in names('handlers'):
+			section = parser['handler_%s' % name]
+			spec = config['handlers'][name] = {
+				'()'    : MyloLogging.ini_handler,
+				'klass' : section.get('class'),
+				'args'  : section.get('args', '()'),
+				'kwargs': section.get('kwargs', '{}'),
+			}
+			if section.get('level'):
+				spec['level'] = section['level']
+			if section.get('formatter'):
+				spec['formatter'] = section['formatter']
+			if section.get('target'):
+				spec['target'] = section['target']
+		for name in names('loggers'):
+			section = parser['logger_%s' % name]
+			spec = {'handlers': handler_names('logger_%s' % name)}
+			if 'level' in section:
+				spec['level'] = section['level']
+			if name == 'root':
+				config['root'] = spec
+			else:
+				spec['propagate'] = section.getint('propagate', fallback=1) == 1
+				config['loggers'][section['qualname']] = spec
+		return config
 
-	def buildQueue(self):
-		que = queue.Queue(-1)  # no limit on size
+	@staticmethod
+	def ini_handler(klass, args='()', kwargs='{}', target=None):
+		# Build a handler from ini strings the way fileConfig does
+		try:
+			klass = eval(klass, vars(logging))
+		except (AttributeError, NameError):
+			from logging.config import _resolve
+			klass = _resolve(klass)
+		return klass(*eval(args, vars(logging)), **eval(kwargs, vars(logging)))
+
+	def listen(self, port=None):
+		# A logging.config listener whose pushed configs are applied by reload_config
+		import logging.config
+		return logging.config.listen(port or logging.config.DEFAULT_LOGGING_CONFIG_PORT, self.verifyConfig)
+
+	def verifyConfig(self, data):
+		import io
+		import json
+		text = data.decode('utf-8')
+		try:
+			config = json.loads(text)
+		except ValueError:
+			config = self.ini_to_dict(io.StringIO(text))
+		try:
+			self.reload_config(config)
+		except Exception:
+			logging.exception("Unable to reload pushed logging config")
+		# Nothing is left for listen() to apply with dictConfig / fileConfig
+		return None
+
+	def makeHandler(self, factory, *args, **kwargs):
+		if self.lazy:
+			return mylog.LazyHandler(factory, *args, **kwargs)
+		return factory(*args, **kwargs)
+
+	def makeQueue(self):
+		if self.maxsize <= 0 and not self.maxbytes:
+			logging.info("Setting queue size to no limit")
+			return queue.Queue(-1)  # no limit on size
+		logging.info("Bounding queue to {} records, {} bytes, overflow {}".format(
+			self.maxsize, self.maxbytes, self.overflow))
+		return mylog.BoundedLogQueue(max(self.maxsize, 0), self.maxbytes, self.overflow)
+
+	def queueStats(self):
+		que = self.quehand.queue
+		if isinstance(que, mylog.BoundedLogQueue):
+			return que.stats()
+		return {'items': que.qsize(), 'dropped': 0}
+
+	def buildQueue(self, fanout=True, rate_limit=None, metrics=False):
+		que = self.makeQueue()
 		self.quehand = mylog.CustomQueueHandler(que)
-		addHandl = self.handlers
-		nam1 = 'listener'
-		num1 = 0
-		for items in addHandl.items():
-			num1 += 1
-			listname = nam1 + str(num1)
-			self.listeners[listname] = mylog.CustomQueueListener(que, items)
+		if rate_limit:
+			# Suppressed records never reach the queue handler's prepare()
+			if rate_limit is True:
+				rate_limit = mylog.RateLimitFilter()
+			rate_limit.attach(self.quehand)
+			self.rate_limit = rate_limit
+		for name, hand in self.handlers.items():
+			# Lanes and listener metrics are labelled with the handler name
+			if not hand.get_name():
+				hand.set_name(name)
+		addHandl = [hand for hand in self.handlers.values()
+		            if not isinstance(hand, mylog.CustomQueueHandler)]
+		if fanout:
+			# One listener dequeues and hands every record to a lane per handler
+			self.listeners['fanout'] = mylog.FanOutQueueListener(que, *addHandl, metrics=metrics)
+		else:
+			nam1 = 'listener'
+			num1 = 0
+			for items in addHandl:
+				num1 += 1
+				listname = nam1 + str(num1)
+				self.listeners[listname] = mylog.CustomQueueListener(que, items, metrics=metrics)
 		self.handlers['quehand'] = self.quehand
 
 	def startQueue(self):
@@ -72,9 +354,24 @@ class MyloLogging:
 			self.listeners[items].start()
 
 	def stopQueue(self):
+		if getattr(self, 'rate_limit', None) is not None:
+			self.rate_limit.close()
+			self.quehand.flush()
 		listenerslist = self.listeners
 		for items in listenerslist:
 			self.listeners[items].stop()
+		if hasattr(self, 'quehand'):
+			logging.info("Queue stats at stop: {}".format(self.queueStats()))
+		for name, snapshot in self.listenerStats().items():
+			logging.info("Listener {} metrics at stop: {}".format(name, snapshot))
+			metrics = self.listeners[name].metrics
+			metrics.close()
+			metrics.unlink()
+
+	def listenerStats(self):
+		# Snapshots of the listeners built with metrics
+		return {name: listener.snapshot() for name, listener in self.listeners.items()
+		        if listener.metrics is not None}
 
 	def loggerSetExtra(self, logname, lvl, handle='quehand'):
 		slgll = self.loggers[logname]
@@ -106,60 +403,68 @@ class MyloLogging:
 	def build_logging(self):
 		# create formatters
 		sfsbf = self.formatters['BOM'] = mylog.SyslogBOMFormatter(logging.BASIC_FORMAT)
-		sfplf = self.formatters['Process'] = logging.Formatter(
+		sfplf = self.formatters['Process'] = mylog.CompiledFormatter(
 			'%(asctime)s %(process)s %(processName)-10s \n%(threadName)s %(name)s %(levelname)-8s \n%(message)s')
-		sftlf = self.formatters['Thread'] = logging.Formatter('%(thread)d %(threadName)s: %(asctime)s - %(message)s')
-		sfslf = self.formatters['Simple'] = logging.Formatter('%(asctime)s - %(name)-12s: %(levelname)-8s %(message)s')
-		sfvlf = self.formatters['Verbose'] = logging.Formatter(
+		sftlf = self.formatters['Thread'] = mylog.CompiledFormatter('%(thread)d %(threadName)s: %(asctime)s - %(message)s')
+		sfslf = self.formatters['Simple'] = mylog.CompiledFormatter('%(asctime)s - %(name)-12s: %(levelname)-8s %(message)s')
+		sfvlf = self.formatters['Verbose'] = mylog.CompiledFormatter(
 			'%(asctime)s %(processName)-10s %(name)s %(levelname)-8s %(message)s')
-		sfuilf = self.formatters['User_Info'] = logging.Formatter(
-			'%(asctime)-15s %(name)-5s %(levelname)-8s HOST: %(host)s IP: %(ip)-15s User: %(user)-8s %(message)s')
+		sfuilf = self.formatters['User_Info'] = mylog.CompiledFormatter(
+			'%(asctime)-15s %(name)-5s %(levelname)-8s HOST: %(host)s IP: %(ip)-15s User: %(user)-8s %(message)s',
+			defaults=self.context.defaults)
 
 		# create SysLog Handler
-		try:
-			shslh = self.handlers['systLog'] = logging.handlers.SysLogHandler(address='/dev/log')
-			shslh.setLevel(os.environ.get("LOGLEVEL", "INFO"))
-		except AttributeError:
-			shslh = self.handlers['systLog'] = logging.handlers.SysLogHandler(
-				facility=logging.handlers.SysLogHandler.LOG_DAEMON)
-			shslh.setLevel(os.environ.get("LOGLEVEL", "INFO"))
+		def syslog():
+			try:
+				return logging.handlers.SysLogHandler(address='/dev/log')
+			except AttributeError:
+				return logging.handlers.SysLogHandler(facility=logging.handlers.SysLogHandler.LOG_DAEMON)
+
+		shslh = self.handlers['systLog'] = self.makeHandler(syslog)
+		shslh.setLevel(os.environ.get("LOGLEVEL", "INFO"))
 		### add formatter to Syslog Handler
 		shslh.setFormatter(sfsbf)
 
 		# create console handler with a higher log level
-		shcsh = self.handlers['consolehand'] = logging.StreamHandler()
+		shcsh = self.handlers['consolehand'] = self.makeHandler(logging.StreamHandler)
 		### add formatter to console
 		shcsh.setFormatter(sftlf)
 
 		# crate Watched File Handler
-		shwfh = self.handlers['watchFile'] = logging.handlers.WatchedFileHandler(
-			os.environ.get("LOGFILE", 'watchedLog.log'))
+		shwfh = self.handlers['watchFile'] = self.makeHandler(
+			mylog.BufferedFileHandler, os.environ.get("LOGFILE", 'watchedLog.log'), watch=True)
 		shwfh.setLevel(os.environ.get("LOGLEVEL", "DEBUG"))
 		### add formatter to File Watcher Handler
 		shwfh.setFormatter(sfvlf)
 
 		# create Socket Handler
-		self.handlers['sockethand'] = logging.handlers.SocketHandler('localhost',
-		                                                             logging.handlers.DEFAULT_TCP_LOGGING_PORT)
+		self.handlers['sockethand'] = self.makeHandler(mylog.BatchingSocketHandler, 'localhost',
+		                                               logging.handlers.DEFAULT_TCP_LOGGING_PORT)
 
 		# create Rotational File Handler
-		shrfh = self.handlers['rotatehand'] = logging.handlers.RotatingFileHandler('rotate.log', 'a', 500, 5)
+		shrfh = self.handlers['rotatehand'] = self.makeHandler(
+			mylog.CompressingRotatingFileHandler, 'rotate.log', 'a', 500, 5)
 		shrfh.setLevel(logging.INFO)
 		### add formatter to Rotational File Handler
 		shrfh.setFormatter(sfvlf)
 
 		# create Main File Handler
-		shmfh = self.handlers['mainfilehand'] = logging.FileHandler('main.log')
+		shmfh = self.handlers['mainfilehand'] = self.makeHandler(mylog.BufferedFileHandler, 'main.log')
 		### add formatter to Main File Handler
 		shmfh.setFormatter(sfslf)
 
 		# create Secondary File Handler
-		shsfh = self.handlers['secondfilehand'] = logging.FileHandler('secondary.log')
+		shsfh = self.handlers['secondfilehand'] = self.makeHandler(mylog.BufferedFileHandler, 'secondary.log')
 		### add formatter to Second File Handler
 		shsfh.setFormatter(sfplf)
 
 		# create User File Handler
-		shufh = self.handlers['userfilehand'] = logging.FileHandler('users.log')
+		shufh = self.handlers['userfilehand'] = self.makeHandler(mylog.BufferedFileHandler, 'users.log')
 		shufh.setLevel(logging.DEBUG)
 		### add formatter to User File Handler
 		shufh.setFormatter(sfuilf)
+
+		# create Memory Mapped Segment Handler
+		shmsh = self.handlers['segmenthand'] = self.makeHandler(mylog.MmapSegmentHandler, 'segments')
+		### add formatter to Segment Handler
+		shmsh.setFormatter(sfvlf)
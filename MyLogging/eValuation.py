@@ -1,10 +1,135 @@
 import ast
+import functools
+import threading
+
+# NumPy is imported by load_numpy() the first time columns are evaluated.
+numpy = None
+_numpy_loaded = False
+
+
+def load_numpy():
+	"""
+	Import NumPy if it is installed and return it, or None.
+	"""
+	global numpy, _numpy_loaded
+	if not _numpy_loaded:
+		_numpy_loaded = True
+		try:
+			import numpy
+		except ImportError:
+			numpy = None
+	return numpy
 
 
 class EvaluationError(ValueError):
 	pass
 
 
+class NotVectorizable(Exception):
+	"""
+	Raised while compiling or running a vectorized expression to make
+	evaluate_columns() fall back to evaluating row by row.
+	"""
+
+
+class ConstantFolder(ast.NodeTransformer):
+	"""
+	Fold BinOp, UnaryOp and Compare nodes whose operands are constants, and
+	tuples of constants, using the evaluator's operators. Operations which
+	raise, are unsupported or would build very large values are left alone,
+	so they behave at run time exactly as before. BoolOp chains drop
+	constants which cannot decide the result and stop at one which does.
+	"""
+
+	max_size = 4096
+
+	def __init__(self, evaluator):
+		self.operators = evaluator.operators
+
+	def _fold(self, node, op, *args):
+		if op is None:
+			return node
+		try:
+			value = op(*args)
+		except Exception:
+			return node
+		if isinstance(value, int) and value.bit_length() > self.max_size:
+			return node
+		if isinstance(value, (str, bytes, tuple)) and len(value) > self.max_size:
+			return node
+		return ast.copy_location(ast.Constant(value), node)
+
+	def _too_big(self, op, lhs, rhs):
+		if not isinstance(rhs, int) or isinstance(rhs, bool):
+			return False
+		if op == 'pow':
+			return abs(rhs) > 128 and lhs not in (0, 1, -1)
+		if op in ('lshift', 'mult'):
+			return rhs > self.max_size
+		return False
+
+	def visit_BinOp(self, node):
+		self.generic_visit(node)
+		if isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
+			name = node.op.__class__.__name__.lower()
+			lhs, rhs = node.left.value, node.right.value
+			if self._too_big(name, lhs, rhs) or self._too_big(name, rhs, lhs):
+				return node
+			return self._fold(node, self.operators.get(name), lhs, rhs)
+		return node
+
+	def visit_UnaryOp(self, node):
+		self.generic_visit(node)
+		if isinstance(node.operand, ast.Constant):
+			name = node.op.__class__.__name__.lower()
+			return self._fold(node, self.operators.get(name), node.operand.value)
+		return node
+
+	def visit_Compare(self, node):
+		self.generic_visit(node)
+		operands = [node.left] + node.comparators
+		if not all(isinstance(n, ast.Constant) for n in operands):
+			return node
+		ops = [self.operators.get(op.__class__.__name__.lower()) for op in node.ops]
+		if None in ops:
+			return node
+
+		def compare():
+			result = True
+			for op, lhs, rhs in zip(ops, operands, operands[1:]):
+				result = op(lhs.value, rhs.value)
+				if not result:
+					break
+			return result
+
+		return self._fold(node, compare)
+
+	def visit_Tuple(self, node):
+		self.generic_visit(node)
+		if all(isinstance(n, ast.Constant) for n in node.elts):
+			return ast.copy_location(ast.Constant(tuple(n.value for n in node.elts)), node)
+		return node
+
+	def visit_BoolOp(self, node):
+		self.generic_visit(node)
+		is_and = isinstance(node.op, ast.And)
+		values = []
+		for n in node.values:
+			if isinstance(n, ast.Constant):
+				if bool(n.value) != is_and:
+					# This constant decides the result; nothing after it runs.
+					values.append(n)
+					break
+				if n is not node.values[-1]:
+					# Cannot decide the result, so evaluation moves on.
+					continue
+			values.append(n)
+		if len(values) == 1:
+			return values[0]
+		node.values = values
+		return node
+
+
 class Evaluator(object):
 	builtin_names = {
 		'None' : None,
@@ -41,10 +166,32 @@ class Evaluator(object):
 
 	handlers = {}
 
+	# Since Python 3.9 a subscript holds the index expression itself; the
+	# older wrapper nodes are gone from ast in newer versions.
+	subscript_types = tuple(t for t in (getattr(ast, name, None) for name in ('Index', 'Ellipsis', 'ExtSlice'))
+	                        if t is not None) + (ast.Slice, ast.expr)
+
+	cache_size = 256
+
+	# Fold constants and share repeated sub-expressions when compiling.
+	optimize_expressions = True
+
+	# Node types which are pure given pure operators, and so can be
+	# evaluated once and shared by every identical occurrence.
+	pure_types = (ast.Name, ast.Constant, ast.Attribute, ast.Subscript, ast.BinOp,
+	              ast.UnaryOp, ast.Compare, ast.Tuple, ast.Slice, ast.Load,
+	              ast.operator, ast.unaryop, ast.cmpop)
+	shared_types = (ast.Attribute, ast.Subscript, ast.BinOp, ast.UnaryOp, ast.Compare)
+
+	_frames = threading.local()
+	_unset = object()
+
 	def __init__(self, context=None, allow_imports=False):
 		self.context = context or {}
 		self.source = None
 		self.allow_imports = allow_imports
+		self._compile_cached = functools.lru_cache(self.cache_size)(self.compile)
+		self._vector_cached = functools.lru_cache(self.cache_size)(self.compile_vector)
 
 	def get_fragment(self, offset):
 		fragment_len = 10
@@ -55,15 +202,10 @@ class Evaluator(object):
 
 	def evaluate(self, node, filename=None):
 		if isinstance(node, str):
+			# Source text is compiled once into closures and cached.
+			compiled = self._compile_cached(node, filename)
 			self.source = node
-			kwargs = dict(mode='eval')
-			if filename:
-				kwargs['filename'] = filename
-			try:
-				node = ast.parse(node, **kwargs)
-			except SyntaxError as e:
-				s = self.get_fragment(e.offset)
-				raise EvaluationError('syntax error %s' % s)
+			return compiled(self.context)
 		node_type = node.__class__.__name__.lower()
 		if node_type in self.handlers:
 			handler = self.handlers[node_type]
@@ -78,6 +220,528 @@ class Evaluator(object):
 				node_type, s))
 		return handler(node)
 
+	def parse(self, source, filename=None):
+		self.source = source
+		kwargs = dict(mode='eval')
+		if filename:
+			kwargs['filename'] = filename
+		try:
+			return ast.parse(source, **kwargs)
+		except SyntaxError as e:
+			s = self.get_fragment(e.offset)
+			raise EvaluationError('syntax error %s' % s)
+
+	def optimize(self, node):
+		"""
+		Return node with constants folded and its repeated pure
+		sub-expressions marked with a cse_slot, which compile_node() turns
+		into a value computed once per evaluation.
+		"""
+		node = ast.fix_missing_locations(ConstantFolder(self).visit(node))
+		counts = {}
+		for n in ast.walk(node):
+			if isinstance(n, self.shared_types) and self.is_pure(n):
+				key = ast.dump(n)
+				counts.setdefault(key, []).append(n)
+		slot = 0
+		for key, nodes in counts.items():
+			if len(nodes) > 1:
+				for n in nodes:
+					n.cse_slot = slot
+				slot += 1
+		node.cse_slots = slot
+		return node
+
+	def is_pure(self, node):
+		return all(isinstance(n, self.pure_types) for n in ast.walk(node))
+
+	def explain(self, source):
+		"""
+		Describe how source is optimized: the folded expression, then each
+		shared sub-expression with the number of times it is used.
+		"""
+		node = self.optimize(self.parse(source))
+		lines = ['optimized: %s' % ast.unparse(node)]
+		shared = {}
+		for n in ast.walk(node):
+			slot = getattr(n, 'cse_slot', None)
+			if slot is not None:
+				shared.setdefault(slot, [ast.unparse(n), 0])[1] += 1
+		for slot, (text, uses) in sorted(shared.items()):
+			lines.append('shared %d: %s (%d uses)' % (slot, text, uses))
+		return '\n'.join(lines)
+
+	def compile(self, source, filename=None):
+		"""
+		Compile source into a function of the context which evaluates it.
+		Errors other than syntax errors are raised when the function runs,
+		at the same point the tree walking evaluate() would raise them.
+		"""
+		node = self.parse(source, filename)
+		if not self.optimize_expressions:
+			return self.compile_node(node)
+		node = self.optimize(node)
+		body = self.compile_node(node)
+		slots = node.cse_slots
+		if not slots:
+			return body
+		frames = self._frames
+		unset = self._unset
+
+		def run(context):
+			# Shared values live in a per-thread frame for this evaluation.
+			outer = getattr(frames, 'frame', None)
+			frames.frame = [unset] * slots
+			try:
+				return body(context)
+			finally:
+				frames.frame = outer
+
+		return run
+
+	def compile_node(self, node):
+		compiled = self._compile_node(node)
+		slot = getattr(node, 'cse_slot', None)
+		if slot is None:
+			return compiled
+		frames = self._frames
+		unset = self._unset
+
+		def shared(context):
+			frame = frames.frame
+			value = frame[slot]
+			if value is unset:
+				value = frame[slot] = compiled(context)
+			return value
+
+		return shared
+
+	def _compile_node(self, node):
+		node_type = node.__class__.__name__.lower()
+		if node_type in self.handlers:
+			handler = self.handlers[node_type]
+			return lambda context: handler(node)
+		name = 'do_%s' % node_type
+		compiler = getattr(self, 'compile_%s' % node_type, None)
+		if compiler is not None and getattr(type(self), name, None) is getattr(Evaluator, name, None):
+			return compiler(node)
+		# No compiler, or a subclass has its own do_ method: walk this node
+		# at run time, against self.context.
+		handler = getattr(self, name, None)
+		if handler is not None:
+			return lambda context: handler(node)
+		source = self.source
+
+		def unknown(context):
+			if source is None:
+				s = '(source not available)'
+			else:
+				s = self.get_fragment(node.col_offset)
+			raise EvaluationError("don't know how to evaluate %r %s" % (
+				node_type, s))
+
+		return unknown
+
+	@staticmethod
+	def _raiser(message):
+		def raise_error(context):
+			raise EvaluationError(message)
+
+		return raise_error
+
+	def compile_attribute(self, node):
+		container = self.compile_node(node.value)
+		attr = node.attr
+		return lambda context: getattr(container(context), attr)
+
+	def compile_binop(self, node):
+		op = node.op.__class__.__name__.lower()
+		if op not in self.operators:
+			return self._raiser('unsupported operation: %r' % op)
+		op = self.operators[op]
+		lhs = self.compile_node(node.left)
+		rhs = self.compile_node(node.right)
+		return lambda context: op(lhs(context), rhs(context))
+
+	def compile_boolop(self, node):
+		first = self.compile_node(node.values[0])
+		rest = [self.compile_node(n) for n in node.values[1:]]
+		is_or = node.op.__class__ is ast.Or
+		is_and = node.op.__class__ is ast.And
+		assert is_or or is_and
+		if is_and:
+			def boolop(context):
+				result = first(context)
+				if result:
+					for n in rest:
+						result = n(context)
+						if not result:
+							break
+				return result
+		else:
+			def boolop(context):
+				result = first(context)
+				if not result:
+					for n in rest:
+						result = n(context)
+						if result:
+							break
+				return result
+		return boolop
+
+	def compile_compare(self, node):
+		left = self.compile_node(node.left)
+		pairs = []
+		for op, right in zip(node.ops, node.comparators):
+			op = op.__class__.__name__.lower()
+			pairs.append((self.operators.get(op), op, self.compile_node(right)))
+		if len(pairs) == 1 and pairs[0][0] is not None:
+			op, name, right = pairs[0]
+			return lambda context: op(left(context), right(context))
+
+		def compare(context):
+			lhs = left(context)
+			result = True
+			for op, name, right in pairs:
+				if op is None:
+					raise EvaluationError('unsupported operation: %r' % name)
+				rhs = right(context)
+				result = op(lhs, rhs)
+				if not result:
+					break
+				lhs = rhs
+			return result
+
+		return compare
+
+	def compile_constant(self, node):
+		value = node.value
+		return lambda context: value
+
+	def compile_dict(self, node):
+		c = self.compile_node
+		items = [(c(k), c(v)) for k, v in zip(node.keys, node.values)]
+		return lambda context: dict((k(context), v(context)) for k, v in items)
+
+	def compile_ellipsis(self, node):
+		return lambda context: Ellipsis
+
+	def compile_expr(self, node):
+		return self.compile_node(node.value)
+
+	compile_index = compile_expr
+
+	def compile_expression(self, node):
+		return self.compile_node(node.body)
+
+	def compile_extslice(self, node):
+		dims = [self.compile_node(n) for n in node.dims]
+		return lambda context: tuple((d(context) for d in dims))
+
+	def compile_list(self, node):
+		elts = [self.compile_node(n) for n in node.elts]
+		return lambda context: list([e(context) for e in elts])
+
+	def compile_name(self, node):
+		name = node.id
+		if name in self.builtin_names:
+			value = self.builtin_names[name]
+			return lambda context: value
+
+		def lookup(context):
+			if name in context:
+				return context[name]
+			if not self.allow_imports:
+				raise EvaluationError('unknown name: %r' % name)
+			try:
+				return __import__(name)
+			except ImportError:
+				raise EvaluationError('unknown name: %r' % name)
+
+		return lookup
+
+	def compile_num(self, node):
+		value = node.n
+		return lambda context: value
+
+	def compile_slice(self, node):
+		c = self.compile_node
+		none = lambda context: None
+		lower = none if node.lower is None else c(node.lower)
+		upper = none if node.upper is None else c(node.upper)
+		step = none if node.step is None else c(node.step)
+		return lambda context: slice(lower(context), upper(context), step(context))
+
+	def compile_str(self, node):
+		value = node.s
+		return lambda context: value
+
+	def compile_subscript(self, node):
+		assert node.ctx.__class__ is ast.Load
+		val = self.compile_node(node.value)
+		if not isinstance(node.slice, self.subscript_types):
+			name = node.slice.__class__.__name__
+
+			def bad_subscript(context):
+				val(context)
+				raise EvaluationError('Unable to get subscript: %r', name)
+
+			return bad_subscript
+		indices = self.compile_node(node.slice)
+		if isinstance(node.slice, ast.ExtSlice):
+			return lambda context: val(context)[(indices(context))]
+		return lambda context: val(context).__getitem__(indices(context))
+
+	def compile_tuple(self, node):
+		elts = [self.compile_node(n) for n in node.elts]
+		return lambda context: tuple([e(context) for e in elts])
+
+	def compile_unaryop(self, node):
+		op = node.op.__class__.__name__.lower()
+		operand = self.compile_node(node.operand)
+		if op not in self.operators:
+			message = 'unsupported operation: %r' % op
+
+			def unsupported(context):
+				operand(context)
+				raise EvaluationError(message)
+
+			return unsupported
+		op = self.operators[op]
+		return lambda context: op(operand(context))
+
+	# Operators whose Python form already works element-wise on arrays.
+	vector_operators = frozenset((
+		'add', 'bitand', 'bitor', 'bitxor', 'div', 'eq', 'floordiv', 'gt', 'gte',
+		'invert', 'lshift', 'lt', 'lte', 'mod', 'mult', 'noteq', 'pow', 'rshift',
+		'sub', 'uadd', 'usub',
+	))
+	# Operators which easily overflow NumPy's fixed width integers, where
+	# Python's would grow; they are only vectorized for floats.
+	vector_float_operators = frozenset(('lshift', 'mult', 'pow'))
+	# Integer results of these are checked for wrap-around instead.
+	vector_checked_operators = frozenset(('add', 'sub', 'usub'))
+	vector_scalars = (int, float, bool, str, bytes, type(None))
+
+	def evaluate_columns(self, source, columns):
+		"""
+		Evaluate source once over columns, a mapping of context names to
+		equal length NumPy arrays, array.array buffers or lists, and return
+		the results as an array (a list if NumPy is not installed); for a
+		filter expression this is a boolean mask. Names not in columns are
+		taken from self.context as scalars.
+
+		Arithmetic, comparison and boolean operators run element-wise in
+		NumPy; "and" / "or" need boolean operands and give a boolean mask,
+		and "in" needs a constant collection on the right. Any expression
+		which cannot be vectorized, or which hits a floating point error
+		such as division by zero, is evaluated row by row with the compiled
+		closures instead, with the usual per-row semantics and errors. So
+		are integer multiplication, powers and left shifts, which could
+		overflow, and integer sums and differences which did.
+		"""
+		lengths = set(len(column) for column in columns.values())
+		if len(lengths) > 1:
+			raise EvaluationError('columns differ in length: %r' % sorted(lengths))
+		rows = lengths.pop() if lengths else 0
+		if load_numpy() is not None:
+			vector = self._vector_cached(source)
+			if vector is not None:
+				arrays = dict((name, numpy.asarray(column)) for name, column in columns.items())
+				try:
+					with numpy.errstate(all='raise'):
+						result = vector(arrays)
+				except (NotVectorizable, FloatingPointError, OverflowError, TypeError, ValueError):
+					pass
+				else:
+					if numpy.ndim(result) == 0:
+						result = numpy.full(rows, result)
+					return result
+		results = self.evaluate_rows(source, columns, rows)
+		if numpy is None:
+			return results
+		if any(type(r) is int and not -1 << 63 <= r < 1 << 63 for r in results):
+			# Keep integers int64 cannot hold exact rather than as floats.
+			return numpy.array(results, dtype=object)
+		return numpy.array(results)
+
+	def evaluate_rows(self, source, columns, rows):
+		"""
+		Evaluate source once per row of columns with the compiled closures.
+		"""
+		compiled = self._compile_cached(source, None)
+		self.source = source
+		columns = [(name, column.tolist() if hasattr(column, 'tolist') else column)
+		           for name, column in columns.items()]
+		context = dict(self.context)
+		results = []
+		for i in range(rows):
+			for name, column in columns:
+				context[name] = column[i]
+			results.append(compiled(context))
+		return results
+
+	def compile_vector(self, source):
+		"""
+		Compile source into a function of a mapping of arrays, or return
+		None if it cannot be vectorized.
+		"""
+		node = self.parse(source)
+		if self.optimize_expressions:
+			node = ast.fix_missing_locations(ConstantFolder(self).visit(node))
+		try:
+			return self.compile_vector_node(node)
+		except NotVectorizable:
+			return None
+
+	def compile_vector_node(self, node):
+		node_type = node.__class__.__name__.lower()
+		compiler = getattr(self, 'compile_vector_%s' % node_type, None)
+		if compiler is None or node_type in self.handlers:
+			raise NotVectorizable(node_type)
+		return compiler(node)
+
+	def compile_vector_expression(self, node):
+		return self.compile_vector_node(node.body)
+
+	def compile_vector_constant(self, node):
+		value = node.value
+		if not isinstance(value, self.vector_scalars):
+			raise NotVectorizable(type(value).__name__)
+		return lambda columns: value
+
+	def compile_vector_name(self, node):
+		name = node.id
+		if name in self.builtin_names:
+			value = self.builtin_names[name]
+			return lambda columns: value
+		scalars = self.vector_scalars
+
+		def lookup(columns):
+			if name in columns:
+				return columns[name]
+			if name in self.context:
+				value = self.context[name]
+				if isinstance(value, scalars):
+					return value
+			raise NotVectorizable(name)
+
+		return lookup
+
+	def _vector_operator(self, op):
+		name = op.__class__.__name__.lower()
+		if name not in self.vector_operators or name not in self.operators:
+			raise NotVectorizable(name)
+		return self.operators[name]
+
+	def compile_vector_binop(self, node):
+		op = self._vector_operator(node.op)
+		lhs = self.compile_vector_node(node.left)
+		rhs = self.compile_vector_node(node.right)
+		name = node.op.__class__.__name__.lower()
+		if name in self.vector_checked_operators:
+			return self._vector_checked(name, op, lhs, rhs)
+		if name not in self.vector_float_operators:
+			return lambda columns: op(lhs(columns), rhs(columns))
+
+		def binop(columns):
+			x = lhs(columns)
+			y = rhs(columns)
+			if numpy.result_type(x, y).kind != 'f':
+				raise NotVectorizable(name)
+			return op(x, y)
+
+		return binop
+
+	def _vector_checked(self, name, op, lhs, rhs=None):
+		"""
+		Wrap an add, sub or usub so that an integer result which wrapped
+		around raises NotVectorizable. Booleans and unsigned integers,
+		whose NumPy arithmetic differs from Python's, are not vectorized.
+		"""
+		def checked(columns):
+			x = lhs(columns)
+			if rhs is None:
+				kind = numpy.result_type(x).kind
+				r = op(x)
+			else:
+				y = rhs(columns)
+				kind = numpy.result_type(x, y).kind
+				r = op(x, y)
+			if kind in 'bu':
+				raise NotVectorizable(name)
+			if kind != 'i':
+				return r
+			# In two's complement a wrapped result has the wrong sign.
+			if rhs is None:
+				wrapped = (x < 0) & (r < 0)
+			elif name == 'add':
+				wrapped = ((x ^ r) & (y ^ r)) < 0
+			else:
+				wrapped = ((x ^ y) & (x ^ r)) < 0
+			if numpy.any(wrapped):
+				raise NotVectorizable(name)
+			return r
+
+		return checked
+
+	def compile_vector_unaryop(self, node):
+		operand = self.compile_vector_node(node.operand)
+		if isinstance(node.op, ast.Not):
+			return lambda columns: numpy.logical_not(operand(columns))
+		op = self._vector_operator(node.op)
+		if isinstance(node.op, ast.USub):
+			return self._vector_checked('usub', op, operand)
+		return lambda columns: op(operand(columns))
+
+	def compile_vector_compare(self, node):
+		left = self.compile_vector_node(node.left)
+		pairs = []
+		for op, right in zip(node.ops, node.comparators):
+			if isinstance(op, (ast.In, ast.NotIn)):
+				try:
+					values = ast.literal_eval(right)
+				except (ValueError, TypeError):
+					raise NotVectorizable('in')
+				if isinstance(values, (str, bytes)):
+					# Substring tests, not membership.
+					raise NotVectorizable('in')
+				try:
+					values = list(values)
+				except TypeError:
+					raise NotVectorizable('in')
+				invert = isinstance(op, ast.NotIn)
+				pairs.append((lambda x, y, invert=invert: numpy.isin(x, y, invert=invert),
+				              lambda columns, values=values: values))
+			else:
+				pairs.append((self._vector_operator(op), self.compile_vector_node(right)))
+
+		def compare(columns):
+			lhs = left(columns)
+			result = None
+			for op, right in pairs:
+				rhs = right(columns)
+				step = op(lhs, rhs)
+				result = step if result is None else result & step
+				lhs = rhs
+			return result
+
+		return compare
+
+	def compile_vector_boolop(self, node):
+		values = [self.compile_vector_node(n) for n in node.values]
+		combine = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+
+		def boolop(columns):
+			results = [value(columns) for value in values]
+			for result in results:
+				if numpy.asarray(result).dtype != bool:
+					# Python's and/or return operands, not masks.
+					raise NotVectorizable('boolop')
+			return combine.reduce(results)
+
+		return boolop
+
 	def do_attribute(self, node):
 		print(node)
 		container = self.evaluate(node.value)
@@ -118,6 +782,9 @@ class Evaluator(object):
 			lhs = rhs
 		return result
 
+	def do_constant(self, node):
+		return node.value
+
 	def do_dict(self, node):
 		e = self.evaluate
 		return dict((e(k), e(v)) for k, v in zip(node.keys, node.values))
@@ -178,8 +845,7 @@ class Evaluator(object):
 	def do_subscript(self, node):
 		assert node.ctx.__class__ is ast.Load
 		val = self.evaluate(node.value)
-		if not isinstance(node.slice, (ast.Index, ast.Slice, ast.Ellipsis,
-		                               ast.ExtSlice)):
+		if not isinstance(node.slice, self.subscript_types):
 			raise EvaluationError('Unable to get subscript: %r',
 			                      node.slice.__class__.__name__)
 		indices = self.evaluate(node.slice)
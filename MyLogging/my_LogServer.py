@@ -0,0 +1,256 @@
+"""
+The receiving end of socket logging: request handlers for
+socketserver and asyncio, and LogRecordSocketReceiver.
+
+These are kept apart from my_Loggin so that importing it does not pull
+in socketserver and asyncio; my_Loggin still exports every name here
+and imports this module the first time one of them is used.
+"""
+import asyncio
+import logging
+import logging.handlers
+import pickle
+import socketserver
+import zlib
+
+from my_Loggin import BatchingSocketHandler, BinaryRecordCodec, FrameBuffer
+
+
+class LogRecordTCPHandler(socketserver.BaseRequestHandler):
+	"""
+	The request handler class for our server.
+
+	It is instantiated once per connection to the server, and must
+	override the handle() method to implement communication to the
+	client.
+	"""
+
+	def handle(self):
+		# self.request is the TCP socket connected to the client
+		self.data = self.request.recv(1024).strip()
+		print("{} wrote:".format(self.client_address[0]))
+		print(self.data)
+		# just send back the same data, but upper-cased
+		self.request.sendall(self.data.upper())
+
+
+class LogRecordThreadingTCPHandler(socketserver.StreamRequestHandler):
+
+	def handle(self):
+		# self.rfile is a file-like object created by the handler;
+		# we can now use e.g. readline() instead of raw recv() calls
+		self.data = self.rfile.readline().strip()
+		print("{} wrote:".format(self.client_address[0]))
+		print(self.data)
+		# Likewise, self.wfile is a file-like object used to write back
+		# to the client
+		self.wfile.write(self.data.upper())
+
+
+class LogRecordStreamHandler(socketserver.StreamRequestHandler):
+	# Handler for a streaming logging request.
+
+	bufsize = 1 << 16
+	codec = None
+	accept_binary = True
+	accept_pickle = True
+	max_batch_size = 64 << 20
+
+	def handle(self):
+		# Handle multiple requests - each expected to be a 4-byte length,
+		# followed by the LogRecord in pickle format.
+		frames = FrameBuffer(self.bufsize)
+		recv_into = self.connection.recv_into
+		while True:
+			for frame in frames:
+				self.handleFrame(frame)
+			nbytes = recv_into(frames.writable())
+			if not nbytes:
+				break
+			frames.filled(nbytes)
+
+	def handleFrame(self, frame):
+		"""
+		Turn one frame, a memoryview into the receive buffer, into a
+		LogRecord and handle it.
+		A sender which opens with the BinaryRecordCodec hello is answered
+		with its ack and its frames are decoded with the codec after that.
+		A compressed batch from BatchingSocketHandler is unpacked and each
+		frame in it handled in turn.
+		"""
+		codec = self.codec
+		if frame[:8] == BatchingSocketHandler.batch_magic:
+			self.handleBatch(frame[8:])
+			return
+		if codec is not None:
+			obj = codec.decode(frame)
+		elif self.accept_binary and frame == BinaryRecordCodec.hello:
+			self.codec = BinaryRecordCodec()
+			self.reply(BinaryRecordCodec.ack)
+			return
+		elif self.accept_pickle:
+			obj = self.unPickle(frame)
+		else:
+			return
+		record = logging.makeLogRecord(obj)
+		self.handleLogRecord(record)
+
+	def handleBatch(self, data):
+		"""
+		Decompress a batch frame and handle the frames inside it.
+		"""
+		unzip = zlib.decompressobj()
+		data = unzip.decompress(data, self.max_batch_size)
+		if unzip.unconsumed_tail:
+			raise ValueError('compressed log batch is larger than %d bytes' % self.max_batch_size)
+		view = memoryview(data)
+		unpack_from = FrameBuffer._length.unpack_from
+		pos = 0
+		while pos < len(data):
+			end = pos + 4 + unpack_from(data, pos)[0]
+			self.handleFrame(view[pos + 4:end])
+			pos = end
+
+	def reply(self, data):
+		self.connection.sendall(data)
+
+	def unPickle(self, data):
+		return pickle.loads(data)
+
+	def handleLogRecord(self, record):
+		# In storage mode records go to the server's LogStore instead.
+		store = getattr(self.server, 'store', None)
+		if store is not None:
+			store.append(record)
+			return
+		if self.server.logname is not None:
+			name = self.server.logname
+		else:
+			name = record.name
+		logger = logging.getLogger(name)
+		logger.handle(record)
+
+
+class LogRecordStreamProtocol(asyncio.BufferedProtocol):
+	"""
+	The asyncio counterpart of LogRecordStreamHandler. The event loop
+	receives straight into a FrameBuffer and each complete frame is passed
+	to an instance of the server's handler class, so customisations of
+	handleFrame, unPickle and handleLogRecord apply to both server modes.
+	"""
+
+	def __init__(self, server):
+		self.server = server
+		self.frames = None
+		self.handler = None
+
+	def connection_made(self, transport):
+		cls = self.server.RequestHandlerClass
+		# The handler is only used for its frame methods, so skip the
+		# __init__ which would run handle() on a blocking socket.
+		self.handler = handler = cls.__new__(cls)
+		handler.server = self.server
+		handler.client_address = transport.get_extra_info('peername')
+		handler.request = handler.connection = transport.get_extra_info('socket')
+		handler.reply = transport.write
+		self.frames = FrameBuffer(getattr(cls, 'bufsize', 1 << 16))
+		self.transport = transport
+		self.server._transports.add(transport)
+
+	def get_buffer(self, sizehint):
+		return self.frames.writable()
+
+	def buffer_updated(self, nbytes):
+		self.frames.filled(nbytes)
+		handle = self.handler.handleFrame
+		for frame in self.frames:
+			handle(frame)
+
+	def connection_lost(self, exc):
+		self.server._transports.discard(self.transport)
+
+
+class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
+	# Simple TCP socket-based logging receiver.
+
+	allow_reuse_address = True
+	timeout = 1
+	async_backlog = 1024
+
+	def __init__(self, host='localhost', port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
+	             handler=LogRecordStreamHandler, timeout=1, store=None):
+		self.abort = 0
+		self.timeout = timeout
+		self.logname = None
+		# A my_Loggin.LogStore to write received records to
+		self.store = store
+
+		try:
+			socketserver.ThreadingTCPServer.__init__(self, (host, port), handler)
+
+		except OSError:
+			nport = 9010
+			socketserver.ThreadingTCPServer.__init__(self, (host, nport), handler)
+
+	def serve_until_stopped(self):
+		try:
+			import select
+			abort = 0
+			while not abort:
+				rd, wr, ex = select.select([self.socket.fileno()],
+				                           [], [],
+				                           self.timeout)
+				if rd:
+					logging.warning("Found request, now handling")
+					self.handle_request()
+				logging.warning("No request, continuing to listen for request....")
+				abort = self.abort
+			else:
+				self.abort = + 1
+				abort = self.abort
+		except KeyboardInterrupt:
+			exit(0)
+		finally:
+			if self.store is not None:
+				self.store.flush()
+
+	def serve_asyncio(self):
+		"""
+		Serve on a single asyncio event loop instead of a thread per
+		connection, until stop_asyncio() is called. Frames are decoded as
+		they stream in through LogRecordStreamProtocol.
+		"""
+		try:
+			asyncio.run(self._serve_asyncio())
+		except KeyboardInterrupt:
+			pass
+
+	async def _serve_asyncio(self):
+		self._loop = loop = asyncio.get_running_loop()
+		self._stopped = asyncio.Event()
+		self._transports = set()
+		# Thousands of senders may connect at once, so raise the backlog
+		# from socketserver's request_queue_size.
+		self.socket.listen(self.async_backlog)
+		server = await loop.create_server(lambda: LogRecordStreamProtocol(self),
+		                                  sock=self.socket)
+		try:
+			await self._stopped.wait()
+		finally:
+			server.close()
+			# Frames are handled as they arrive, so open connections have
+			# nothing left to deliver.
+			for transport in list(self._transports):
+				transport.close()
+			await server.wait_closed()
+			self._loop = None
+			if self.store is not None:
+				self.store.flush()
+
+	def stop_asyncio(self):
+		"""
+		Stop serve_asyncio() from any thread.
+		"""
+		loop = getattr(self, '_loop', None)
+		if loop is not None:
+			loop.call_soon_threadsafe(self._stopped.set)
@@ -1,17 +1,52 @@
+import ast
+import bisect
+import collections
+import contextvars
+import functools
+import gzip
+import importlib
 import logging
-import logging.config
 import logging.handlers
-import multiprocessing
+import mmap
+import operator
+import os
 import pickle
-import socketserver
+import re
+import shutil
 import struct
-from multiprocessing import Process
+import threading
+import time
+import zlib
+
+import eValuation as eVal
 
 try:
 	import Queue as queue
 except ImportError:
 	import queue
 
+# multiprocessing, asyncio, socketserver and logging.config are only
+# imported by the code that needs them, so a process which just logs to a
+# file does not pay for them at startup. The socket receiving classes
+# live in my_LogServer and are loaded by __getattr__ on first use.
+_lazy = dict.fromkeys(('LogRecordTCPHandler', 'LogRecordThreadingTCPHandler', 'LogRecordStreamHandler',
+                       'LogRecordStreamProtocol', 'LogRecordSocketReceiver'), 'my_LogServer')
+
+
+def __getattr__(name):
+	if name in _lazy:
+		value = globals()[name] = getattr(importlib.import_module(_lazy[name]), name)
+		return value
+	raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+class LogRecordBatch(list):
+	"""
+	A list of prepared LogRecords which travels through the queue as a
+	single item. CustomQueueListener unpacks it and handles each record
+	in order.
+	"""
+
 
 class CustomQueueHandler(logging.Handler):
 	"""
@@ -19,14 +54,34 @@ class CustomQueueHandler(logging.Handler):
 	with a multiprocessing Queue to centralise logging to file in one process
 	(in a multi-process application), so as to avoid file write contention
 	between processes.
+
+	If batch_size is greater than one, prepared records are collected into a
+	LogRecordBatch and enqueued as one item, so a multiprocessing queue pays
+	for one pickle and one pipe write per batch instead of per record. A batch
+	is sent when it holds batch_size records, when linger seconds have passed
+	since its first record was added, or on flush() / close().
+
+	If lazy is true, records whose arguments are all plain values are sent
+	with msg and args as they are, and the listener does the interpolation
+	once for all of its handlers. Other records are formatted here as usual.
 	"""
 
-	def __init__(self, queue):
+	lazy_types = frozenset((str, int, float, bool, bytes, type(None)))
+
+	def __init__(self, queue, batch_size=1, linger=0.05, lazy=False):
 		"""
 		Initialise an instance, using the passed queue.
 		"""
 		logging.Handler.__init__(self)
 		self.queue = queue
+		self.lazy = lazy
+		self.batch_size = batch_size
+		self.linger = linger
+		self._batch = LogRecordBatch()
+		self._batch_due = None
+		self._linger_wake = threading.Event()
+		self._linger_thread = None
+		self._closed = False
 
 	def enqueue(self, record):
 		"""
@@ -54,24 +109,520 @@ class CustomQueueHandler(logging.Handler):
 		# msg + args, as these might be unpickleable. We also zap the
 		# exc_info attribute, as it's no longer needed and, if not None,
 		# will typically not be pickleable.
+		if self.lazy and self.can_defer(record):
+			if record.exc_info:
+				if not record.exc_text:
+					formatter = self.formatter or logging._defaultFormatter
+					record.exc_text = formatter.formatException(record.exc_info)
+				record.exc_info = None
+			return record
 		self.format(record)
 		record.msg = record.message
 		record.args = None
 		record.exc_info = None
 		return record
 
+	def can_defer(self, record):
+		"""
+		Return True if the record's message can be interpolated by the
+		listener, which is when its args (or the args of a StyleAdapter
+		Message) are all plain values that pickle cheaply and cannot change
+		after the call.
+		"""
+		msg = record.msg
+		args = record.args
+		if isinstance(msg, Message):
+			if args:
+				return False
+			args = msg.args
+		elif not isinstance(msg, str):
+			return False
+		if not args:
+			return True
+		if isinstance(args, dict):
+			args = args.values()
+		lazy_types = self.lazy_types
+		for arg in args:
+			if type(arg) not in lazy_types:
+				return False
+		return True
+
 	def emit(self, record):
 		"""
 		Emit a record.
 		Writes the LogRecord to the queue, preparing it for pickling first.
+		In batching mode the prepared record is added to the current batch,
+		which is enqueued once it is full.
 		"""
 		try:
-			self.enqueue(self.prepare(record))
+			if self.batch_size > 1:
+				self.add_to_batch(self.prepare(record))
+			else:
+				self.enqueue(self.prepare(record))
 		except (KeyboardInterrupt, SystemExit):
 			raise
 		except:
 			self.handleError(record)
 
+	def add_to_batch(self, record):
+		"""
+		Add a prepared record to the current batch, sending the batch if it
+		has reached batch_size.
+		"""
+		with self.lock:
+			batch = self._batch
+			batch.append(record)
+			if len(batch) >= self.batch_size:
+				self._send_batch()
+			elif len(batch) == 1:
+				self._batch_due = time.monotonic() + self.linger
+				if self._linger_thread is None:
+					self._start_linger()
+				self._linger_wake.set()
+
+	def _send_batch(self):
+		"""
+		Enqueue the current batch and start a new one. Must be called with
+		the handler lock held.
+		"""
+		batch = self._batch
+		if not batch:
+			return
+		self._batch = LogRecordBatch()
+		self._batch_due = None
+		self.enqueue(batch)
+
+	def _start_linger(self):
+		self._linger_thread = t = threading.Thread(target=self._linger,
+		                                           name='que_linger')
+		t.daemon = True
+		t.start()
+
+	def _linger(self):
+		"""
+		Send batches whose linger time has expired.
+		This method runs on a separate, internal thread.
+		"""
+		while not self._closed:
+			due = self._batch_due
+			if due is None:
+				self._linger_wake.wait()
+				self._linger_wake.clear()
+				continue
+			delay = due - time.monotonic()
+			if delay > 0:
+				self._linger_wake.wait(delay)
+				self._linger_wake.clear()
+				continue
+			with self.lock:
+				due = self._batch_due
+				if due is not None and due <= time.monotonic():
+					try:
+						self._send_batch()
+					except Exception:
+						self._batch = LogRecordBatch()
+						self._batch_due = None
+
+	def flush(self):
+		"""
+		Enqueue any records waiting in the current batch.
+		"""
+		with self.lock:
+			self._send_batch()
+
+	def close(self):
+		"""
+		Flush the current batch and stop the linger thread.
+		"""
+		try:
+			self.flush()
+		finally:
+			self._closed = True
+			self._linger_wake.set()
+			logging.Handler.close(self)
+
+
+class BoundedLogQueue(queue.Queue):
+	"""
+	A queue for CustomQueueHandler which is bounded by both the number of
+	items and their approximate total size in bytes.
+
+	overflow decides what happens to an item which does not fit:
+
+	'block'        wait up to timeout seconds for room, then drop the item
+	'drop_newest'  drop the item being added
+	'drop_oldest'  drop the oldest queued items until the new one fits
+	'drop_lowest'  drop the oldest of the lowest level items until the new
+	               one fits, or the new item if nothing queued is lower
+
+	Dropped items are counted in dropped and dropped_by_level; see stats().
+	Items are kept in one deque per level, so finding the oldest item or
+	the lowest level only looks at the head of each deque.
+	"""
+
+	policies = ('block', 'drop_newest', 'drop_oldest', 'drop_lowest')
+	record_overhead = 512
+
+	def __init__(self, maxsize=10000, maxbytes=0, overflow='drop_oldest', timeout=1.0):
+		if overflow not in self.policies:
+			raise ValueError('unknown overflow policy: %r' % overflow)
+		self.maxbytes = maxbytes
+		self.overflow = overflow
+		self.timeout = timeout
+		self.dropped = 0
+		self.dropped_by_level = {}
+		queue.Queue.__init__(self, maxsize)
+
+	def _init(self, maxsize):
+		self.levels = {}
+		self.bytes = 0
+		self._count = 0
+		self._seq = 0
+
+	def _qsize(self):
+		return self._count
+
+	def sizeof(self, item):
+		"""
+		Estimate the memory held by a queued record or LogRecordBatch from
+		the lengths of its text, without pickling it.
+		"""
+		if isinstance(item, LogRecordBatch):
+			return sum(self.sizeof(record) for record in item)
+		size = self.record_overhead
+		for text in (getattr(item, 'msg', None), getattr(item, 'exc_text', None),
+		             getattr(item, 'stack_info', None)):
+			if isinstance(text, str):
+				size += len(text)
+		return size
+
+	@staticmethod
+	def levelof(item):
+		if isinstance(item, LogRecordBatch):
+			return max(record.levelno for record in item) if item else logging.NOTSET
+		return getattr(item, 'levelno', logging.NOTSET)
+
+	def _put(self, item):
+		size = self.sizeof(item)
+		level = self.levelof(item)
+		self._seq += 1
+		bucket = self.levels.get(level)
+		if bucket is None:
+			bucket = self.levels[level] = collections.deque()
+		bucket.append((self._seq, item, size))
+		self._count += 1
+		self.bytes += size
+
+	def _oldest(self):
+		"""
+		Return the deque holding the oldest item.
+		"""
+		return min((b for b in self.levels.values() if b), key=lambda b: b[0][0])
+
+	def _get(self):
+		seq, item, size = self._oldest().popleft()
+		self._count -= 1
+		self.bytes -= size
+		return item
+
+	def _fits(self, size):
+		if 0 < self.maxsize <= self._count:
+			return False
+		if self.maxbytes and self._count and self.bytes + size > self.maxbytes:
+			return False
+		return True
+
+	def _drop(self, item):
+		level = self.levelof(item)
+		count = len(item) if isinstance(item, LogRecordBatch) else 1
+		self.dropped += count
+		self.dropped_by_level[level] = self.dropped_by_level.get(level, 0) + count
+
+	def _evict(self, level):
+		"""
+		Drop queued items to make room for an item of the given level,
+		according to the overflow policy. Returns False if the new item
+		should be dropped instead.
+		"""
+		if self.overflow == 'drop_oldest':
+			bucket = self._oldest()
+		else:
+			lowest = min(lvl for lvl, b in self.levels.items() if b)
+			if lowest >= level:
+				return False
+			bucket = self.levels[lowest]
+		seq, item, size = bucket.popleft()
+		self._count -= 1
+		self.bytes -= size
+		self._drop(item)
+		# The evicted item will never be task_done()'d, so finish it here.
+		self.unfinished_tasks -= 1
+		if not self.unfinished_tasks:
+			self.all_tasks_done.notify_all()
+		return True
+
+	def put(self, item, block=None, timeout=None):
+		"""
+		Put an item into the queue, applying the overflow policy if it does
+		not fit. Returns False if the item was dropped. The listener
+		sentinel (None) is always accepted.
+		"""
+		with self.not_full:
+			if item is not None:
+				size = self.sizeof(item)
+				if not self._fits(size):
+					if self.overflow == 'block' and block is not False:
+						if timeout is None:
+							timeout = self.timeout
+						if not self.not_full.wait_for(lambda: self._fits(size), timeout):
+							self._drop(item)
+							return False
+					elif self.overflow == 'block' or self.overflow == 'drop_newest':
+						self._drop(item)
+						return False
+					else:
+						level = self.levelof(item)
+						while not self._fits(size):
+							if not self._evict(level):
+								self._drop(item)
+								return False
+			self._put(item)
+			self.unfinished_tasks += 1
+			self.not_empty.notify()
+			return True
+
+	def put_nowait(self, item):
+		"""
+		Put an item into the queue. Unlike Queue.put_nowait this honours the
+		overflow policy, so a 'block' queue will still wait for room.
+		"""
+		return self.put(item)
+
+	def stats(self):
+		"""
+		Return a snapshot of the queue's fill level and drop counts.
+		"""
+		with self.mutex:
+			return {
+				'items'           : self._count,
+				'bytes'           : self.bytes,
+				'dropped'         : self.dropped,
+				'dropped_by_level': dict(self.dropped_by_level),
+			}
+
+
+class ListenerMetrics(object):
+	"""
+	Counters for a CustomQueueListener kept in multiprocessing shared
+	memory, so a listener running in its own process can be watched from
+	the process that started it.
+
+	The listener counts the records it takes off the queue and the time
+	its monitor spends blocked on the queue versus working. Each handler
+	gets a slot with its number of records, its handleError calls and a
+	histogram of emit latency in power of two microsecond buckets. Every
+	counter has a single writer, so no lock is needed.
+
+	snapshot() adds the queue depth and drop count and turns the counters
+	into rates since the previous snapshot.
+	"""
+
+	# dequeued, busy_ns, idle_ns, started_ns, slots in use, then spare
+	_header = 8
+	_name_size = 64
+
+	def __init__(self, max_handlers=32, buckets=24, name=None):
+		self.max_handlers = max_handlers
+		self.buckets = buckets
+		self.slot_size = 3 + buckets  # count, errors, total_ns, histogram
+		counters = self._header + max_handlers * self.slot_size
+		size = 8 * counters + self._name_size * max_handlers
+		from multiprocessing import shared_memory
+		if name is None:
+			self.shm = shared_memory.SharedMemory(create=True, size=size)
+			self.shm.buf[:size] = bytes(size)
+		else:
+			self.shm = shared_memory.SharedMemory(name=name)
+		self.counters = self.shm.buf[:8 * counters].cast('Q')
+		self.names = self.shm.buf[8 * counters:size]
+		self._slots = {}
+		self._last = None
+
+	def __reduce__(self):
+		return self.__class__, (self.max_handlers, self.buckets, self.name)
+
+	@property
+	def name(self):
+		return self.shm.name
+
+	def start(self):
+		self.counters[3] = time.time_ns()
+
+	def register(self, handlers):
+		"""
+		Give each handler a slot, reusing the slot of a handler with the same
+		name.
+		"""
+		for handler in handlers:
+			self.slot(handler)
+
+	def count_errors(self, handlers):
+		"""
+		Count the handleError calls of each handler in its slot. Call this in
+		the process the handlers run in.
+		"""
+		for handler in handlers:
+			base = self.slot(handler)
+			if base is None or getattr(handler.handleError, 'metrics', None) is self:
+				continue
+			handler.handleError = self._error_counter(handler.handleError, base)
+
+	def _error_counter(self, handle_error, base):
+		counters = self.counters
+
+		def handleError(record):
+			counters[base + 1] += 1
+			return handle_error(record)
+
+		handleError.metrics = self
+		return handleError
+
+	def slot(self, handler):
+		try:
+			return self._slots[handler]
+		except KeyError:
+			pass
+		counters = self.counters
+		name = handler.get_name() or '%s-%d' % (type(handler).__name__, counters[4])
+		encoded = name.encode('utf-8', 'replace')[:self._name_size]
+		for index in range(counters[4]):
+			if self._slot_name(index) == encoded:
+				break
+		else:
+			index = counters[4]
+			if index >= self.max_handlers:
+				self._slots[handler] = None
+				return None
+			start = index * self._name_size
+			self.names[start:start + len(encoded)] = encoded
+			counters[4] = index + 1
+		base = self._slots[handler] = self._header + index * self.slot_size
+		return base
+
+	def _slot_name(self, index):
+		start = index * self._name_size
+		return bytes(self.names[start:start + self._name_size]).rstrip(b'\x00')
+
+	def add_records(self, count):
+		self.counters[0] += count
+
+	def add_busy(self, ns):
+		self.counters[1] += ns
+
+	def add_idle(self, ns):
+		self.counters[2] += ns
+
+	def observe(self, handler, ns):
+		"""
+		Record one emit by handler which took ns nanoseconds.
+		"""
+		base = self._slots.get(handler, False)
+		if base is False:
+			base = self.slot(handler)
+		if base is None:
+			return
+		counters = self.counters
+		counters[base] += 1
+		counters[base + 2] += ns
+		counters[base + 3 + min(self.buckets - 1, (ns >> 10).bit_length())] += 1
+
+	def _histogram(self, base):
+		counters = self.counters
+		return [counters[base + 3 + b] for b in range(self.buckets)]
+
+	@staticmethod
+	def _quantile(histogram, fraction):
+		"""
+		Return the upper bound in microseconds of the bucket holding the
+		given fraction of the observations.
+		"""
+		total = sum(histogram)
+		if not total:
+			return 0
+		seen = 0
+		for bucket, count in enumerate(histogram):
+			seen += count
+			if seen >= fraction * total:
+				return 1 << bucket
+		return 1 << (len(histogram) - 1)
+
+	def snapshot(self, queue=None):
+		"""
+		Return the current counters as a dict. Rates cover the time since
+		the previous snapshot, or since the listener started.
+		"""
+		counters = self.counters
+		now = time.time_ns()
+		depth = dropped = None
+		if queue is not None:
+			try:
+				depth = queue.qsize()
+			except (NotImplementedError, AttributeError):
+				pass
+			if hasattr(queue, 'stats'):
+				dropped = queue.stats()['dropped']
+			else:
+				dropped = getattr(queue, 'dropped', None)
+		dequeued = counters[0]
+		arrived = dequeued + (depth or 0) + (dropped or 0)
+		last = self._last or (counters[3] or now, 0, 0)
+		self._last = (now, arrived, dequeued)
+		elapsed = max(now - last[0], 1) / 1e9
+		handlers = {}
+		errors = 0
+		for index in range(min(counters[4], self.max_handlers)):
+			base = self._header + index * self.slot_size
+			count = counters[base]
+			histogram = self._histogram(base)
+			errors += counters[base + 1]
+			handlers[self._slot_name(index).decode('utf-8', 'replace')] = {
+				'records'  : count,
+				'errors'   : counters[base + 1],
+				'mean_us'  : counters[base + 2] / count / 1e3 if count else 0.0,
+				'p50_us'   : self._quantile(histogram, 0.5),
+				'p99_us'   : self._quantile(histogram, 0.99),
+				'histogram': [(1 << b, n) for b, n in enumerate(histogram) if n],
+			}
+		busy, idle = counters[1], counters[2]
+		return {
+			'depth'       : depth,
+			'dequeued'    : dequeued,
+			'dropped'     : dropped,
+			'errors'      : errors,
+			'in_per_sec'  : (arrived - last[1]) / elapsed,
+			'out_per_sec' : (dequeued - last[2]) / elapsed,
+			'busy_seconds': busy / 1e9,
+			'idle_seconds': idle / 1e9,
+			'busy_ratio'  : busy / (busy + idle) if busy + idle else 0.0,
+			'handlers'    : handlers,
+		}
+
+	def close(self):
+		self.counters.release()
+		self.names.release()
+		self.shm.close()
+
+	def unlink(self):
+		self.shm.unlink()
+
+	def __del__(self):
+		# The views have to go before SharedMemory can close its mapping.
+		try:
+			self.counters.release()
+			self.names.release()
+		except (AttributeError, ValueError):
+			pass
+
 
 class CustomQueueListener(logging.handlers.QueueListener):
 	"""
@@ -81,23 +632,77 @@ class CustomQueueListener(logging.handlers.QueueListener):
 	"""
 
 	_sentinel = None
+	stop_timeout = 5.0
 
-	def __init__(self, queue, *handlers):
+	def __init__(self, queue, *handlers, metrics=None):
 		super(CustomQueueListener, self).__init__(queue, *handlers)
 		"""
 		Initialise an instance with the specified queue and
-		handlers.
+		handlers. If metrics is true, or a ListenerMetrics, the listener
+		keeps counters which snapshot() reads.
 		"""
+		if metrics is True:
+			metrics = ListenerMetrics()
+		self.metrics = metrics or None
 		# Changing this to a list from tuple in the parent class
 		self.queue = queue
 		# self.handlers = handlers
 		# self._stop = threading.Event()
 		# self._thread = None
 
-		self.handlers = list(handlers)
-		self._stop = multiprocessing.Event()
+		self.handlers = handlers
+		# Made by start(), which knows whether the monitor is a process.
+		self._stop = None
 		self._process = None
 
+	@property
+	def handlers(self):
+		"""
+		The attached handlers, in the order they were added. Use addHandler,
+		removeHandler and setHandlerLevel to change them; a level set on a
+		handler directly is noticed on the next record.
+		"""
+		return tuple(self._handlers)
+
+	@handlers.setter
+	def handlers(self, handlers):
+		# A dict keeps insertion order and gives constant time membership.
+		self._handlers = dict.fromkeys(handlers)
+		self._rebuild_dispatch()
+
+	def _rebuild_dispatch(self):
+		"""
+		Recompute the table mapping a record level to the handlers whose
+		level lets it through. Standard levels are filled in up front and
+		any other level is added the first time a record carries it.
+		"""
+		levels = [h.level for h in self._handlers]
+		dispatch = {}
+		for level in logging._levelToName:
+			dispatch[level] = self._handlers_for(level)
+		# One assignment, so a record sees either the old table or the new.
+		self._dispatch = dispatch
+		self._levels = levels
+
+	def _handlers_for(self, levelno):
+		return tuple(h for h in self._handlers if levelno >= h.level)
+
+	def _dispatch_for(self, levelno):
+		handlers = self._dispatch[levelno] = self._handlers_for(levelno)
+		return handlers
+
+	def _lookup(self, levelno):
+		"""
+		Return the dispatch table entry for levelno, rebuilding the table
+		first if a handler's level was changed with its own setLevel().
+		"""
+		if [h.level for h in self._handlers] != self._levels:
+			self._rebuild_dispatch()
+		try:
+			return self._dispatch[levelno]
+		except KeyError:
+			return self._dispatch_for(levelno)
+
 	# def dequeue(self, block):
 	# 	"""
 	# 	Dequeue a record and return it, optionally blocking.
@@ -116,48 +721,115 @@ class CustomQueueListener(logging.handlers.QueueListener):
 		# t.setDaemon(True)
 		# t.start()
 
-		self._process = sps = Process(target=self._monitor, name='que_monitor')
+		# A queue.Queue only exists in this process, so its monitor has to be
+		# a thread; anything else is assumed to be shareable with a process.
+		if self.metrics is not None:
+			self.metrics.register(self._handlers)
+			self.metrics.start()
+		if isinstance(self.queue, queue.Queue):
+			self._stop = threading.Event()
+			sps = threading.Thread(target=self._monitor, name='que_monitor')
+		else:
+			import multiprocessing
+			self._stop = multiprocessing.Event()
+			sps = multiprocessing.Process(target=self._monitor, name='que_monitor')
+		self._process = sps
 		sps.daemon = True
 		sps.start()
 
 	def prepare(self, record):
 		"""
 		Prepare a record for handling.
-		This method just returns the passed-in record. You may want to
-		override this method if you need to do any custom marshalling or
-		manipulation of the record before passing it to the handlers.
+		This merges the message and arguments of records sent by a lazy
+		CustomQueueHandler, so that the handlers share one interpolation.
+		You may want to override this method if you need to do any custom
+		marshalling or manipulation of the record before passing it to the
+		handlers.
 		"""
-
+		if record.args or not isinstance(record.msg, str):
+			record.msg = record.getMessage()
+			record.args = None
 		return record
 
 	def handle(self, record):
 		"""
 		Override handle a record.
 
-		This just loops through the handlers offering them the record
-		to handle.
+		This looks up the handlers for the record's level in the dispatch
+		table and offers them the record to handle.
 
 		:param record: The record to handle.
 		"""
 		record = self.prepare(record)
-		for handler in self.handlers:
-			if record.levelno >= handler.level:  # This check is not in the parent class
+		# Only handlers whose level admits the record are in the table entry.
+		handlers = self._lookup(record.levelno)
+		metrics = self.metrics
+		if metrics is None:
+			for handler in handlers:
 				handler.handle(record)
+			return
+		clock = time.perf_counter_ns
+		for handler in handlers:
+			started = clock()
+			handler.handle(record)
+			metrics.observe(handler, clock() - started)
+
+	def handle_item(self, item):
+		"""
+		Handle one item taken off the queue, which is either a single
+		record or a LogRecordBatch of records from a batching
+		CustomQueueHandler.
+		"""
+		if isinstance(item, LogRecordBatch):
+			handle = self.handle
+			for record in item:
+				handle(record)
+			count = len(item)
+		else:
+			self.handle(item)
+			count = 1
+		if self.metrics is not None:
+			self.metrics.add_records(count)
 
 	def addHandler(self, hdlr):
 		"""
 		Add the specified handler to this logger.
 		"""
-		if not (hdlr in self.handlers):
-			self.handlers.append(hdlr)
+		if hdlr not in self._handlers:
+			self._handlers[hdlr] = None
+			self._rebuild_dispatch()
 
 	def removeHandler(self, hdlr):
 		"""
 		Remove the specified handler from this logger.
 		"""
-		if hdlr in self.handlers:
+		if hdlr in self._handlers:
 			hdlr.close()
-			self.handlers.remove(hdlr)
+			del self._handlers[hdlr]
+			self._rebuild_dispatch()
+
+	def replaceHandlers(self, mapping):
+		"""
+		Swap attached handlers while the listener runs: each handler which
+		is a key of mapping is replaced by its value, in the same position,
+		or removed if the value is None. The monitor keeps draining and each
+		record goes to either the old handlers or the new ones. Replaced
+		handlers are not closed.
+
+		A listener running in its own process has its own copies of the
+		handlers, which this cannot reach.
+		"""
+		handlers = [mapping.get(h, h) for h in self._handlers]
+		if handlers != list(self._handlers):
+			self.handlers = [h for h in handlers if h is not None]
+
+	def setHandlerLevel(self, hdlr, level):
+		"""
+		Set the level of an attached handler and update the dispatch table.
+		"""
+		hdlr.setLevel(level)
+		if hdlr in self._handlers:
+			self._rebuild_dispatch()
 
 	def _monitor(self):
 		"""
@@ -168,23 +840,33 @@ class CustomQueueListener(logging.handlers.QueueListener):
 		"""
 		q = self.queue
 		has_task_done = hasattr(q, 'task_done')
+		metrics = self.metrics
+		if metrics is not None:
+			metrics.count_errors(self._handlers)
+		clock = time.perf_counter_ns
 		while not self._stop.is_set():
+			started = clock()
 			try:
 				record = self.dequeue(True)
 				if record is self._sentinel:
 					break
-				self.handle(record)
+				dequeued = clock()
+				self.handle_item(record)
 				if has_task_done:
 					q.task_done()
+				if metrics is not None:
+					metrics.add_idle(dequeued - started)
+					metrics.add_busy(clock() - dequeued)
 			except queue.Empty:
-				pass
+				if metrics is not None:
+					metrics.add_idle(clock() - started)
 		# There might still be records in the queue.
 		while True:
 			try:
 				record = self.dequeue(False)
 				if record is self._sentinel:
 					break
-				self.handle(record)
+				self.handle_item(record)
 				if has_task_done:
 					q.task_done()
 			except queue.Empty:
@@ -201,208 +883,2452 @@ class CustomQueueListener(logging.handlers.QueueListener):
 		self.queue.put_nowait(self._sentinel)
 		# self._thread.join()
 		# self._thread = None
-		self._process.terminate()
+		# Give the monitor a chance to drain before it is killed.
+		self._process.join(self.stop_timeout)
+		if self._process.is_alive() and hasattr(self._process, 'terminate'):
+			self._process.terminate()
 		self._process = None
 
+	def snapshot(self):
+		"""
+		Return the listener's metrics with the current queue depth, or
+		None if it was created without metrics.
+		"""
+		if self.metrics is None:
+			return None
+		return self.metrics.snapshot(self.queue)
 
-class LogRecordTCPHandler(socketserver.BaseRequestHandler):
-	"""
-	The request handler class for our server.
 
-	It is instantiated once per connection to the server, and must
-	override the handle() method to implement communication to the
-	client.
+class HandlerLane(object):
+	"""
+	A thread with its own queue which feeds records to a single handler, so
+	that the handler's speed does not affect any other handler.
 	"""
 
-	def handle(self):
-		# self.request is the TCP socket connected to the client
-		self.data = self.request.recv(1024).strip()
-		print("{} wrote:".format(self.client_address[0]))
-		print(self.data)
-		# just send back the same data, but upper-cased
-		self.request.sendall(self.data.upper())
-
+	_sentinel = None
 
-class LogRecordThreadingTCPHandler(socketserver.StreamRequestHandler):
+	def __init__(self, handler, maxsize=0, metrics=None):
+		self.handler = handler
+		self.queue = queue.Queue(maxsize)
+		self.metrics = metrics
+		self._thread = None
 
-	def handle(self):
-		# self.rfile is a file-like object created by the handler;
-		# we can now use e.g. readline() instead of raw recv() calls
-		self.data = self.rfile.readline().strip()
-		print("{} wrote:".format(self.client_address[0]))
-		print(self.data)
-		# Likewise, self.wfile is a file-like object used to write back
-		# to the client
-		self.wfile.write(self.data.upper())
+	def start(self):
+		self._thread = t = threading.Thread(target=self._run,
+		                                    name='lane_%s' % self.handler.get_name())
+		t.daemon = True
+		t.start()
 
+	def put(self, record):
+		self.queue.put(record)
 
-class LogRecordStreamHandler(socketserver.StreamRequestHandler):
-	# Handler for a streaming logging request.
-	def handle(self):
-		# Handle multiple requests - each expected to be a 4-byte length,
-		# followed by the LogRecord in pickle format.
+	def _run(self):
+		"""
+		Hand records to the handler in the order they were queued.
+		This method runs on a separate, internal thread.
+		"""
+		get = self.queue.get
+		handler = self.handler
+		handle = handler.handle
+		metrics = self.metrics
+		clock = time.perf_counter_ns
 		while True:
-			chunk = self.connection.recv(4)
-			if len(chunk) < 4:
+			record = get()
+			if record is self._sentinel:
 				break
-			slen = struct.unpack('>L', chunk)[0]
-			chunk = self.connection.recv(slen)
-			while len(chunk) < slen:
-				chunk = chunk + self.connection.recv(slen - len(chunk))
-				obj = self.unPickle(chunk)
-				record = logging.makeLogRecord(obj)
-				self.handleLogRecord(record)
-
-	def unPickle(self, data):
-		return pickle.loads(data)
-
-	def handleLogRecord(self, record):
-		if self.server.logname is not None:
-			name = self.server.logname
-		else:
-			name = record.name
-		logger = logging.getLogger(name)
-		logger.handle(record)
-
+			if metrics is None:
+				handle(record)
+			else:
+				started = clock()
+				handle(record)
+				metrics.observe(handler, clock() - started)
 
-class SyslogBOMFormatter(logging.Formatter):
-	def format(self, record):
-		result = super().format(record)
-		return result
+	def stop(self):
+		"""
+		Let the lane finish the records already queued, then end the thread.
+		"""
+		self.queue.put(self._sentinel)
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
 
 
-class OneLineExceptionFormatter(logging.Formatter):
-	def formatException(self, exc_info):
-		result = super().formatException(exc_info)
-		return repr(result)
+class FanOutQueueListener(CustomQueueListener):
+	"""
+	A CustomQueueListener which delivers every record to every handler
+	through a HandlerLane per handler. The monitor only dequeues and routes,
+	so a slow SocketHandler or SysLogHandler holds up its own lane and
+	nothing else, while each handler still sees records in queue order.
 
-	def format(self, record):
-		result = super().format(record)
-		if record.exc_text:
-			result = result.replace("\n", "")
-		return result
+	Lanes are threads in the listener process: the listener is a daemon
+	process and so cannot start lane processes of its own.
+	"""
 
+	_lanes_running = False
+
+	def __init__(self, queue, *handlers, lane_size=0, metrics=None):
+		self.lane_size = lane_size
+		self._lanes = {}
+		if metrics is True:
+			metrics = ListenerMetrics()
+		self.metrics = metrics or None
+		super(FanOutQueueListener, self).__init__(queue, *handlers, metrics=self.metrics)
+
+	def _rebuild_dispatch(self):
+		lanes = self._lanes
+		for hdlr in self._handlers:
+			if hdlr not in lanes:
+				lanes[hdlr] = lane = HandlerLane(hdlr, self.lane_size, self.metrics)
+				if self._lanes_running:
+					lane.start()
+		super(FanOutQueueListener, self)._rebuild_dispatch()
+		# Retire lanes only once the new table no longer routes to them.
+		for hdlr in list(lanes):
+			if hdlr not in self._handlers:
+				lanes.pop(hdlr).stop()
+
+	def _handlers_for(self, levelno):
+		# The table holds the lanes' put methods rather than the handlers.
+		return tuple(self._lanes[h].put for h in self._handlers if levelno >= h.level)
 
-class ContextFilter(logging.Filter):
+	def handle(self, record):
+		"""
+		Queue the record on the lane of every handler whose level admits it.
+		Lanes format at the same time, so each but the last gets a shallow
+		copy, keeping the message, asctime and exc_text that formatters set
+		on it from leaking between handlers.
+		"""
+		record = self.prepare(record)
+		puts = self._lookup(record.levelno)
+		if not puts:
+			return
+		for put in puts[:-1]:
+			put(logging.makeLogRecord(record.__dict__))
+		puts[-1](record)
 
-	def __init__(self, userslist, ipslist, hostslist):
-		logging.Filter.__init__(self)
-		self.users = userslist
-		self.ips = ipslist
-		self.hosts = hostslist
+	def _monitor(self):
+		"""
+		Start the lanes, route records to them until the sentinel arrives,
+		then let every lane drain.
+		This method runs in a separate process.
+		"""
+		self._lanes_running = True
+		for lane in self._lanes.values():
+			lane.start()
+		try:
+			super(FanOutQueueListener, self)._monitor()
+		finally:
+			for lane in self._lanes.values():
+				lane.stop()
 
-	def filter(self, record):
-		record.ip = self.ips
-		record.user = self.users
-		record.host = self.hosts
-		return True, record.user, record.ip, record.host
 
+class SharedRingBuffer(object):
+	"""
+	A single-consumer ring buffer in multiprocessing shared memory which
+	can stand in for the queue given to CustomQueueHandler.
+
+	Producers in any process write length-prefixed pickled records into the
+	buffer under a shared lock; a SharedRingListener reads them back in place.
+	Nothing goes through a pipe, so a put costs one pickle and one memory copy.
+
+	full_policy decides what a put does when there is no room for the frame:
+	'drop' discards the record and counts it in dropped, 'block' waits up to
+	timeout seconds for the reader and then raises queue.Full, and 'raise'
+	raises queue.Full straight away.
+
+	Pass the ring to other processes when starting them, so they share its
+	lock. Attaching by name needs that lock passed in as well, as a lock
+	cannot be looked up by name and writers with locks of their own would
+	overwrite each other's frames.
+	"""
 
-class LoggingContext(object):
-	def __init__(self, logger, level=None, handler=None, close=True):
-		self.logger = logger
-		self.level = level
-		self.handler = handler
-		self.close = close
+	_header = struct.Struct('<QQQQQ')  # head, tail, dropped, items put, items read
+	_header_size = 64
+	_frame = struct.Struct('<I')
+	_wrap = 0xFFFFFFFF
+	policies = ('drop', 'block', 'raise')
+
+	def __init__(self, capacity=1 << 20, full_policy='drop', timeout=1.0,
+	             poll_interval=0.001, name=None, lock=None):
+		if full_policy not in self.policies:
+			raise ValueError('unknown full_policy: %r' % full_policy)
+		if name is not None and lock is None:
+			raise ValueError('attaching to a ring by name needs the lock of the ring')
+		import multiprocessing
+		from multiprocessing import shared_memory
+		if name is None:
+			self.shm = shared_memory.SharedMemory(
+				create=True, size=self._header_size + capacity)
+			self._header.pack_into(self.shm.buf, 0, 0, 0, 0, 0, 0)
+		else:
+			self.shm = shared_memory.SharedMemory(name=name)
+		self.capacity = capacity
+		self.full_policy = full_policy
+		self.timeout = timeout
+		self.poll_interval = poll_interval
+		self.lock = multiprocessing.Lock() if lock is None else lock
 
-	def __enter__(self):
-		if self.level is not None:
-			self.old_level = self.logger.level
-			self.logger.setLevel(self.level)
-		if self.handler:
-			self.logger.addHandler(self.handler)
+	@property
+	def name(self):
+		return self.shm.name
 
-	def __exit__(self, et, ev, tb):
-		if self.level is not None:
-			self.logger.setLevel(self.old_level)
-		if self.handler:
-			self.logger.removeHandler(self.handler)
-		if self.handler and self.close:
-			self.handler.close()
+	@property
+	def dropped(self):
+		return self._header.unpack_from(self.shm.buf, 0)[2]
 
+	def qsize(self):
+		"""
+		Return the number of items waiting to be read; like Queue.qsize a
+		batch counts as one item.
+		"""
+		head, tail, dropped, written, read = self._header.unpack_from(self.shm.buf, 0)
+		return max(written - read, 0)
 
-class Log_Server():
-	def start_log_server(self, port):
-		# read initial config file
-		# logging.config.fileConfig('logging.conf')
-		# create and start listener on port
-		print('Log Server Started')
-		self.t = logging.config.listen(port)
-		self.t.start()
-		logger = logging.getLogger('log server log')
+	def nbytes(self):
+		"""
+		Return the number of bytes waiting to be read.
+		"""
+		head, tail, dropped, written, read = self._header.unpack_from(self.shm.buf, 0)
+		return head - tail
 
-	def stop_log_server(self):
-		# cleanup
-		print('Log Server Stopped')
-		logging.config.stopListening()
-		self.t.join()
+	def empty(self):
+		return self.nbytes() == 0
 
+	def encode(self, obj):
+		"""
+		Encode a queue item. Records are sent as their attribute dict, as
+		SocketHandler does, and batches as a list of such dicts.
+		"""
+		if isinstance(obj, logging.LogRecord):
+			obj = obj.__dict__
+		elif isinstance(obj, LogRecordBatch):
+			obj = [record.__dict__ for record in obj]
+		return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
 
-class Message(object):
-	def __init__(self, fmt, args):
-		self.fmt = fmt
-		self.args = args
+	def decode(self, data):
+		"""
+		Turn an encoded frame back into a record, a LogRecordBatch or the
+		listener sentinel.
+		"""
+		obj = pickle.loads(data)
+		if isinstance(obj, dict):
+			return logging.makeLogRecord(obj)
+		if isinstance(obj, list):
+			return LogRecordBatch(logging.makeLogRecord(d) for d in obj)
+		return obj
+
+	def put(self, obj, block=None, timeout=None):
+		"""
+		Write one item into the buffer, applying full_policy if there is
+		not enough free space. Returns False if the item was dropped.
+		"""
+		data = self.encode(obj)
+		size = len(data)
+		frame = self._frame.size + size
+		if frame > self.capacity:
+			raise ValueError('record of %d bytes does not fit in a ring of %d' % (
+				size, self.capacity))
+		if block is None:
+			block = self.full_policy == 'block'
+		if timeout is None:
+			timeout = self.timeout
+		deadline = None
+		buf = self.shm.buf
+		base = self._header_size
+		capacity = self.capacity
+		while True:
+			with self.lock:
+				head, tail, dropped, written, read = self._header.unpack_from(buf, 0)
+				index = head % capacity
+				room = capacity - index
+				# Frames never straddle the end of the buffer; the gap left
+				# at the end is skipped by the reader.
+				need = frame if room >= frame else room + frame
+				if capacity - (head - tail) >= need:
+					if room < frame:
+						if room >= self._frame.size:
+							self._frame.pack_into(buf, base + index, self._wrap)
+						head += room
+						index = 0
+					self._frame.pack_into(buf, base + index, size)
+					start = base + index + self._frame.size
+					buf[start:start + size] = data
+					# Publish the frame only once it is completely written.
+					struct.pack_into('<Q', buf, 0, head + frame)
+					struct.pack_into('<Q', buf, 24, written + 1)
+					return True
+				if not block:
+					if self.full_policy == 'drop':
+						struct.pack_into('<Q', buf, 16, dropped + 1)
+						return False
+					raise queue.Full
+			now = time.monotonic()
+			if deadline is None:
+				deadline = now + timeout
+			elif now >= deadline:
+				raise queue.Full
+			time.sleep(self.poll_interval)
+
+	def put_nowait(self, obj):
+		"""
+		Write one item into the buffer. Unlike Queue.put_nowait this honours
+		full_policy, so a 'block' ring will still wait for room.
+		"""
+		return self.put(obj)
 
-	def __str__(self):
-		return self.fmt.format(*self.args)
+	def drain(self, callback, limit=None):
+		"""
+		Decode the frames currently in the buffer and pass each item to
+		callback. Frames are decoded straight out of shared memory and the
+		read position is published once per call. Reading stops after the
+		sentinel (None), which is also passed to callback, or after limit
+		items. Returns the number of items read.
+		"""
+		buf = self.shm.buf
+		base = self._header_size
+		capacity = self.capacity
+		frame_size = self._frame.size
+		head, tail, dropped, written, read = self._header.unpack_from(buf, 0)
+		count = 0
+		try:
+			while tail < head:
+				index = tail % capacity
+				room = capacity - index
+				if room < frame_size:
+					tail += room
+					continue
+				size = self._frame.unpack_from(buf, base + index)[0]
+				if size == self._wrap:
+					tail += room
+					continue
+				start = base + index + frame_size
+				with buf[start:start + size] as view:
+					item = self.decode(view)
+				tail += frame_size + size
+				count += 1
+				callback(item)
+				if item is None or (limit is not None and count >= limit):
+					break
+		finally:
+			struct.pack_into('<Q', buf, 8, tail)
+			struct.pack_into('<Q', buf, 32, read + count)
+			if tail == head:
+				# Start over at the front once empty, so a large frame is not
+				# kept waiting on a gap left at the end of the buffer.
+				with self.lock:
+					if struct.unpack_from('<Q', buf, 0)[0] == tail:
+						struct.pack_into('<QQ', buf, 0, 0, 0)
+		return count
+
+	def get(self, block=True, timeout=None):
+		"""
+		Remove and return one item, for use as a plain queue.
+		"""
+		items = []
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while not self.drain(items.append, 1):
+			if not block or (deadline is not None and time.monotonic() >= deadline):
+				raise queue.Empty
+			time.sleep(self.poll_interval)
+		return items[0]
 
+	def get_nowait(self):
+		return self.get(False)
 
-class StyleAdapter(logging.LoggerAdapter):
-	def __init__(self, logger, extra=None):
-		super(StyleAdapter, self).__init__(logger, extra or {})
+	def close(self):
+		self.shm.close()
 
-	def log(self, level, msg, *args, **kwargs):
-		if self.isEnabledFor(level):
-			msg, kwargs = self.process(msg, kwargs)
-			self.logger._log(level, Message(msg, args), (), **kwargs)
+	def unlink(self):
+		self.shm.unlink()
 
 
-class CustomAdapter(logging.LoggerAdapter):
-	def process(self, msg, kwargs):
-		return '[%s] %s' % (self.extra['connid'], msg), kwargs
+class SharedRingListener(CustomQueueListener):
+	"""
+	A CustomQueueListener which reads from a SharedRingBuffer. Each pass of
+	the monitor loop handles every frame in the buffer, and the loop backs
+	off to the ring's poll_interval only while the buffer is empty.
+	"""
 
+	def _monitor(self):
+		"""
+		Drain the ring buffer until the sentinel arrives or stop() is called.
+		This method runs in a separate process.
+		"""
+		ring = self.queue
+		seen = []
 
-class LogRecordSocketReceiver(socketserver.ThreadingTCPServer):
-	# Simple TCP socket-based logging receiver.
+		def handle(item):
+			if item is self._sentinel:
+				seen.append(item)
+			else:
+				self.handle_item(item)
 
-	allow_reuse_address = True
-	timeout = 1
+		metrics = self.metrics
+		if metrics is not None:
+			metrics.count_errors(self._handlers)
+		clock = time.perf_counter_ns
+		while not self._stop.is_set():
+			started = clock()
+			if not ring.drain(handle):
+				time.sleep(ring.poll_interval)
+				if metrics is not None:
+					metrics.add_idle(clock() - started)
+			elif seen:
+				return
+			elif metrics is not None:
+				metrics.add_busy(clock() - started)
+		# There might still be records in the buffer.
+		if not seen:
+			ring.drain(handle)
+
+
+class FrameBuffer(object):
+	"""
+	A reusable receive buffer for a stream of 4-byte length prefixed frames.
+	Bytes are received straight into it through writable() and every
+	complete frame is handed out as a memoryview, so nothing is copied
+	except to move a partial frame to the front of the buffer.
+	"""
 
-	def __init__(self, host='localhost', port=logging.handlers.DEFAULT_TCP_LOGGING_PORT,
-	             handler=LogRecordStreamHandler, timeout=1):
-		self.abort = 0
-		self.timeout = timeout
-		self.logname = None
+	_length = struct.Struct('>L')
 
-		try:
-			socketserver.ThreadingTCPServer.__init__(self, (host, port), handler)
+	def __init__(self, size=1 << 16):
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		self.start = self.end = 0
+		self.need = 4
 
-		except OSError:
-			nport = 9010
-			socketserver.ThreadingTCPServer.__init__(self, (host, nport), handler)
+	def __iter__(self):
+		"""
+		Yield each complete frame received so far.
+		"""
+		buf = self.buf
+		view = self.view
+		unpack_from = self._length.unpack_from
+		self.need = 4
+		while self.end - self.start >= 4:
+			start = self.start
+			need = 4 + unpack_from(buf, start)[0]
+			if self.end - start < need:
+				self.need = need
+				break
+			self.start = start + need
+			yield view[start + 4:start + need]
 
-	def serve_until_stopped(self):
-		try:
-			import select
-			abort = 0
-			while not abort:
-				rd, wr, ex = select.select([self.socket.fileno()],
-				                           [], [],
-				                           self.timeout)
-				if rd:
-					logging.warning("Found request, now handling")
-					self.handle_request()
-				logging.warning("No request, continuing to listen for request....")
-				abort = self.abort
+	def writable(self):
+		"""
+		Return a memoryview of the free space to receive into, first
+		making room for the frame in progress.
+		"""
+		buf = self.buf
+		start, end, need = self.start, self.end, self.need
+		if start == end:
+			self.start = self.end = 0
+		elif len(buf) - start < need or len(buf) - end < 4096:
+			# Move the partial frame to the front, growing the buffer
+			# if the frame is bigger than it.
+			pending = end - start
+			if need > len(buf):
+				new = bytearray(max(need, 2 * len(buf)))
+				new[:pending] = buf[start:end]
+				self.buf = new
+				self.view = memoryview(new)
 			else:
-				self.abort = + 1
-				abort = self.abort
-		except KeyboardInterrupt:
-			exit(0)
+				buf[:pending] = buf[start:end]
+			self.start, self.end = 0, pending
+		return self.view[self.end:]
+
+	def filled(self, nbytes):
+		"""
+		Record that nbytes were received into the last writable() view.
+		"""
+		self.end += nbytes
+
+
+class BinaryRecordCodec(object):
+	"""
+	A compact binary encoding of LogRecords for one socket connection, used
+	instead of pickle once BinarySocketHandler and LogRecordStreamHandler
+	have exchanged hello and ack.
+
+	Level, times, pid, thread id and line number are fixed-width fields.
+	Logger names, paths, format strings and the like go through a string
+	table: the first time a string is sent it is written out and both ends
+	add it to their table, after that only its index is sent. Message
+	arguments and extra attributes are sent as tagged values, and only
+	None, bool, int, float, str, list and tuple are ever decoded, so a
+	frame cannot run code on the receiver.
+	"""
+
+	hello = b'\x00MYLOBIN1'
+	ack = b'\x00MYLOACK1'
+	table_size = 4096
+
+	_fixed = struct.Struct('<idddIQI')
+	_double = struct.Struct('<d')
+	table_fields = ('name', 'levelname', 'pathname', 'filename', 'module',
+	                'funcName', 'processName', 'threadName')
+	standard_fields = frozenset(logging.makeLogRecord({}).__dict__) | frozenset(
+		('message', 'asctime', 'taskName'))
+
+	def __init__(self):
+		self.strings = {}
+		self.table = []
+
+	@staticmethod
+	def _varint(n, out):
+		while n > 0x7f:
+			out.append((n & 0x7f) | 0x80)
+			n >>= 7
+		out.append(n)
+
+	@staticmethod
+	def _read_varint(data, pos):
+		result = shift = 0
+		while True:
+			byte = data[pos]
+			pos += 1
+			result |= (byte & 0x7f) << shift
+			if byte < 0x80:
+				return result, pos
+			shift += 7
+
+	def _string(self, s, out):
+		"""
+		Write a string through the string table: an index shifted left with
+		the low bit set for a known string, otherwise the length shifted
+		left followed by the UTF-8 bytes.
+		"""
+		index = self.strings.get(s)
+		if index is not None:
+			self._varint(index << 1 | 1, out)
+			return
+		data = s.encode('utf-8')
+		self._varint(len(data) << 1, out)
+		out += data
+		if len(self.table) < self.table_size:
+			self.strings[s] = len(self.table)
+			self.table.append(s)
+
+	def _read_string(self, data, pos):
+		n, pos = self._read_varint(data, pos)
+		if n & 1:
+			return self.table[n >> 1], pos
+		end = pos + (n >> 1)
+		s = str(data[pos:end], 'utf-8')
+		if len(self.table) < self.table_size:
+			self.table.append(s)
+		return s, end
+
+	def _value(self, value, out):
+		if value is None:
+			out += b'N'
+		elif value is True:
+			out += b'T'
+		elif value is False:
+			out += b'F'
+		elif isinstance(value, int):
+			out += b'i'
+			# Zigzag so small negative numbers stay short.
+			self._varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+		elif isinstance(value, float):
+			out += b'f'
+			out += self._double.pack(value)
+		elif isinstance(value, (list, tuple)):
+			out += b'l' if isinstance(value, list) else b't'
+			self._varint(len(value), out)
+			for item in value:
+				self._value(item, out)
+		else:
+			if not isinstance(value, str):
+				value = str(value)
+			data = value.encode('utf-8')
+			out += b's'
+			self._varint(len(data), out)
+			out += data
+
+	def _read_value(self, data, pos):
+		tag = data[pos]
+		pos += 1
+		if tag == 0x4e:  # N
+			return None, pos
+		if tag == 0x54:  # T
+			return True, pos
+		if tag == 0x46:  # F
+			return False, pos
+		if tag == 0x69:  # i
+			n, pos = self._read_varint(data, pos)
+			return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+		if tag == 0x66:  # f
+			return self._double.unpack_from(data, pos)[0], pos + 8
+		if tag == 0x73:  # s
+			n, pos = self._read_varint(data, pos)
+			return str(data[pos:pos + n], 'utf-8'), pos + n
+		if tag in (0x6c, 0x74):  # l, t
+			n, pos = self._read_varint(data, pos)
+			items = []
+			for i in range(n):
+				item, pos = self._read_value(data, pos)
+				items.append(item)
+			return (items if tag == 0x6c else tuple(items)), pos
+		raise ValueError('unknown value tag %r in binary log record' % tag)
+
+	def _simple(self, value):
+		if value is None or isinstance(value, (bool, int, float, str)):
+			return True
+		if isinstance(value, (list, tuple)):
+			return all(self._simple(item) for item in value)
+		return False
+
+	def encode(self, record):
+		"""
+		Encode a LogRecord, whose exc_text should already be filled in.
+		If encoding fails the strings it added to the table are taken out
+		again, as the receiver never sees the frame.
+		"""
+		mark = len(self.table)
+		try:
+			return self._encode(record)
+		except Exception:
+			for s in self.table[mark:]:
+				del self.strings[s]
+			del self.table[mark:]
+			raise
+
+	def _encode(self, record):
+		out = bytearray(self._fixed.pack(
+			record.levelno, record.created, record.msecs, record.relativeCreated,
+			record.process or 0, record.thread or 0, record.lineno or 0))
+		for field in self.table_fields:
+			self._string(getattr(record, field, None) or '', out)
+		args = record.args
+		if isinstance(record.msg, str) and isinstance(args, tuple) and self._simple(args):
+			# Send the template through the string table and format on the
+			# receiver, so a repeated message costs little more than its args.
+			out.append(1)
+			self._string(record.msg, out)
+			self._value(args, out)
+		else:
+			out.append(0)
+			self._value(record.getMessage(), out)
+		self._value(record.exc_text, out)
+		self._value(record.stack_info, out)
+		extras = [k for k in record.__dict__ if k not in self.standard_fields]
+		self._varint(len(extras), out)
+		for key in extras:
+			self._string(key, out)
+			self._value(getattr(record, key), out)
+		return out
+
+	def decode(self, data):
+		"""
+		Decode a frame into the attribute dict of a LogRecord.
+		"""
+		(levelno, created, msecs, relative, process, thread,
+		 lineno) = self._fixed.unpack_from(data, 0)
+		d = {
+			'levelno'        : levelno,
+			'created'        : created,
+			'msecs'          : msecs,
+			'relativeCreated': relative,
+			'process'        : process or None,
+			'thread'         : thread or None,
+			'lineno'         : lineno,
+			'exc_info'       : None,
+		}
+		pos = self._fixed.size
+		for field in self.table_fields:
+			d[field], pos = self._read_string(data, pos)
+		templated = data[pos]
+		pos += 1
+		if templated:
+			d['msg'], pos = self._read_string(data, pos)
+			d['args'], pos = self._read_value(data, pos)
+		else:
+			d['msg'], pos = self._read_value(data, pos)
+			d['args'] = None
+		d['exc_text'], pos = self._read_value(data, pos)
+		d['stack_info'], pos = self._read_value(data, pos)
+		count, pos = self._read_varint(data, pos)
+		for i in range(count):
+			key, pos = self._read_string(data, pos)
+			d[key], pos = self._read_value(data, pos)
+		return d
+
+
+class BinarySocketHandler(logging.handlers.SocketHandler):
+	"""
+	A SocketHandler which offers the BinaryRecordCodec when it connects.
+	If the receiver answers with the codec's ack the connection carries
+	binary records, otherwise the handler reconnects and sends pickles as
+	SocketHandler does.
+	"""
+
+	negotiate_timeout = 1.0
+
+	def __init__(self, host, port):
+		logging.handlers.SocketHandler.__init__(self, host, port)
+		self.codec = None
+		self.binary = True
+
+	def makeSocket(self, timeout=1):
+		sock = logging.handlers.SocketHandler.makeSocket(self, timeout)
+		self.codec = None
+		if not self.binary:
+			return sock
+		hello = BinaryRecordCodec.hello
+		ack = BinaryRecordCodec.ack
+		try:
+			sock.settimeout(self.negotiate_timeout)
+			sock.sendall(struct.pack('>L', len(hello)) + hello)
+			reply = b''
+			while len(reply) < len(ack):
+				chunk = sock.recv(len(ack) - len(reply))
+				if not chunk:
+					break
+				reply += chunk
+			sock.settimeout(timeout)
+		except OSError:
+			reply = b''
+		if reply == ack:
+			self.codec = BinaryRecordCodec()
+			return sock
+		# The receiver does not know the codec and has dropped the hello or
+		# the connection; start again with pickles.
+		sock.close()
+		self.binary = False
+		return logging.handlers.SocketHandler.makeSocket(self, timeout)
+
+	def emit(self, record):
+		"""
+		Connect before encoding, so the record is encoded for the codec
+		negotiated on this connection.
+		"""
+		try:
+			if self.sock is None:
+				self.createSocket()
+			self.send(self.makePickle(record))
+		except Exception:
+			self.handleError(record)
+
+	def makePickle(self, record):
+		codec = self.codec
+		if codec is None:
+			return logging.handlers.SocketHandler.makePickle(self, record)
+		if record.exc_info and not record.exc_text:
+			# Fill in exc_text, as SocketHandler.makePickle does.
+			self.format(record)
+		data = codec.encode(record)
+		return struct.pack('>L', len(data)) + data
+
+
+class BatchingSocketHandler(BinarySocketHandler):
+	"""
+	A socket handler which never does network I/O on the calling thread.
+	emit() only appends the record to a bounded spool; a background thread
+	takes up to batch_size records at a time, encodes them, compresses the
+	lot with zlib and sends it as a single batch frame over a persistent
+	connection. While the receiver is unreachable records stay in the spool,
+	the oldest being dropped (and counted in dropped) once it is full, and
+	the thread reconnects with exponential backoff.
+
+	Batch frames are only sent to a receiver which acked the
+	BinaryRecordCodec hello; an older receiver gets one frame per record.
+	"""
+
+	batch_magic = b'\x00MYLOZB1'
+
+	def __init__(self, host, port, batch_size=500, flush_interval=0.5,
+	             spool_size=10000, compresslevel=6, max_backoff=30.0):
+		BinarySocketHandler.__init__(self, host, port)
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.spool_size = spool_size
+		self.compresslevel = compresslevel
+		self.max_backoff = max_backoff
+		self.dropped = 0
+		self._spool = collections.deque()
+		self._ready = threading.Condition(threading.Lock())
+		self._closed = False
+		self._sender = None
+
+	def emit(self, record):
+		"""
+		Spool a record for the sender thread.
+		"""
+		try:
+			if record.exc_info and not record.exc_text:
+				# Render the traceback now, while exc_info is still valid.
+				self.format(record)
+			with self._ready:
+				spool = self._spool
+				if len(spool) >= self.spool_size:
+					spool.popleft()
+					self.dropped += 1
+				spool.append(record)
+				if self._sender is None:
+					self._start_sender()
+				if len(spool) >= self.batch_size:
+					self._ready.notify()
+		except Exception:
+			self.handleError(record)
+
+	def _start_sender(self):
+		self._sender = t = threading.Thread(target=self._send_loop,
+		                                    name='socket_batcher')
+		t.daemon = True
+		t.start()
+
+	def _send_loop(self):
+		"""
+		Send spooled records in batches until closed.
+		This method runs on a separate, internal thread.
+		"""
+		backoff = 0
+		spool = self._spool
+		while True:
+			with self._ready:
+				if not self._closed and len(spool) < self.batch_size:
+					self._ready.wait(self.flush_interval)
+				if not spool:
+					if self._closed:
+						break
+					continue
+				batch = [spool.popleft() for i in range(min(self.batch_size, len(spool)))]
+			try:
+				self.sendBatch(batch)
+				backoff = 0
+			except OSError:
+				with self._ready:
+					# Put the batch back in front, keeping the spool bounded.
+					room = self.spool_size - len(spool)
+					if room < len(batch):
+						self.dropped += len(batch) - room
+						batch = batch[len(batch) - room:] if room > 0 else []
+					spool.extendleft(reversed(batch))
+					if self._closed:
+						break
+					backoff = min(self.max_backoff, backoff * 2 or 0.1)
+					# Back off however full the spool is; only close() cuts it short.
+					self._ready.wait_for(lambda: self._closed, backoff)
+			except Exception:
+				# Retrying will not help, so report the batch and go on.
+				for record in batch:
+					self.handleError(record)
+
+	def sendBatch(self, batch):
+		"""
+		Encode and send a list of records, connecting first if needed.
+		A record which cannot be encoded goes to handleError and is left
+		out. Raises OSError if the receiver cannot be reached.
+		"""
+		if self.sock is None:
+			self.sock = self.makeSocket()
+		frames = []
+		for record in batch:
+			try:
+				frames.append(self.makePickle(record))
+			except Exception:
+				self.handleError(record)
+		if not frames:
+			return
+		try:
+			if self.codec is None:
+				self.sock.sendall(b''.join(frames))
+				return
+			data = self.batch_magic + zlib.compress(b''.join(frames), self.compresslevel)
+			self.sock.sendall(struct.pack('>L', len(data)) + data)
+		except OSError:
+			sock, self.sock = self.sock, None
+			sock.close()
+			raise
+
+	def flush(self):
+		"""
+		Wake the sender thread to send whatever is spooled.
+		"""
+		with self._ready:
+			self._ready.notify()
+
+	def close(self, timeout=5.0):
+		"""
+		Send what is left in the spool, waiting at most timeout seconds for
+		the sender, then close the connection.
+		"""
+		with self._ready:
+			self._closed = True
+			self._ready.notify()
+		sender = self._sender
+		if sender is not None:
+			sender.join(timeout)
+		BinarySocketHandler.close(self)
+
+
+class CompiledFormatter(logging.Formatter):
+	"""
+	A drop-in logging.Formatter for %-style format strings which compiles
+	the string once into a positional format and an attrgetter for just the
+	fields it names, instead of interpolating over the whole record dict.
+
+	The asctime text is cached per second and per date format and shared by
+	every CompiledFormatter, so strftime runs once a second rather than once
+	per record per formatter. Output is the same as logging.Formatter's.
+
+	defaults maps fields to the values used for records which lack them,
+	such as the LogContext keys nothing has bound.
+	"""
+
+	_field = re.compile(r'%%|%\((\w+)\)([#0+ -]*\d*(?:\.\d+)?[diouxXeEfFgGcrsa])')
+	_time_cache = {}
+
+	def __init__(self, fmt=None, datefmt=None, style='%', validate=True, defaults=None):
+		logging.Formatter.__init__(self, fmt, datefmt, style, validate)
+		self.defaults = defaults or {}
+		if style == '%':
+			self._render = self.compile(self._style._fmt, self.defaults)
+		else:
+			self._render = None
+		self._uses_time = self.usesTime()
+
+	@classmethod
+	def compile(cls, fmt, defaults=None):
+		"""
+		Return a function rendering fmt for a record, taking fields the
+		record lacks from defaults.
+		"""
+		fields = []
+
+		def positional(match):
+			if match.group(1) is None:
+				return '%%'
+			fields.append(match.group(1))
+			return '%' + match.group(2)
+
+		template = cls._field.sub(positional, fmt)
+		if not fields:
+			text = template % ()
+			return lambda record: text
+		if defaults and any(name in defaults for name in fields):
+			getters = [operator.attrgetter(name) if name not in defaults else
+			           (lambda record, name=name, default=defaults[name]: getattr(record, name, default))
+			           for name in fields]
+			return lambda record: template % tuple(get(record) for get in getters)
+		getter = operator.attrgetter(*fields)
+		if len(fields) == 1:
+			return lambda record: template % (getter(record),)
+		return lambda record: template % getter(record)
+
+	def formatTime(self, record, datefmt=None):
+		timefmt = datefmt or self.default_time_format
+		key = (timefmt, self.converter)
+		second = int(record.created)
+		cached = self._time_cache.get(key)
+		if cached is not None and cached[0] == second:
+			text = cached[1]
+		else:
+			text = time.strftime(timefmt, self.converter(record.created))
+			self._time_cache[key] = (second, text)
+		if datefmt or not self.default_msec_format:
+			return text
+		return self.default_msec_format % (text, record.msecs)
+
+	def format(self, record):
+		render = self._render
+		if render is None:
+			return logging.Formatter.format(self, record)
+		record.message = record.getMessage()
+		if self._uses_time:
+			record.asctime = self.formatTime(record, self.datefmt)
+		try:
+			s = render(record)
+		except AttributeError as e:
+			raise ValueError('Formatting field not found in record: %s' % e)
+		if record.exc_info:
+			# Cache the traceback text to avoid converting it multiple times
+			# (it's constant anyway)
+			if not record.exc_text:
+				record.exc_text = self.formatException(record.exc_info)
+		if record.exc_text:
+			if s[-1:] != "\n":
+				s = s + "\n"
+			s = s + record.exc_text
+		if record.stack_info:
+			if s[-1:] != "\n":
+				s = s + "\n"
+			s = s + self.formatStack(record.stack_info)
+		return s
+
+
+class BufferedFileHandler(logging.handlers.WatchedFileHandler):
+	"""
+	A file handler which group-commits records: formatted lines are kept in
+	memory and written with a single write and flush per batch instead of
+	one per record.
+
+	A batch is written when it reaches buffer_size characters, when the
+	oldest pending line is flush_interval seconds old, or straight away for
+	a record at or above flush_level. So at most flush_interval seconds of
+	records below flush_level are ever waiting in memory. With fsync set,
+	every batch is also synced to disk.
+
+	With watch set the file is reopened, as WatchedFileHandler does, when it
+	has been moved or removed; that check is made once per batch.
+	"""
+
+	def __init__(self, filename, mode='a', encoding=None, delay=False, errors=None,
+	             buffer_size=1 << 16, flush_interval=1.0, flush_level=logging.ERROR,
+	             fsync=False, watch=False):
+		logging.handlers.WatchedFileHandler.__init__(self, filename, mode, encoding,
+		                                             delay, errors)
+		self.buffer_size = buffer_size
+		self.flush_interval = flush_interval
+		self.flush_level = flush_level
+		self.fsync = fsync
+		self.watch = watch
+		self._pending = []
+		self._pending_size = 0
+		self._pending_since = None
+		self._wake = threading.Event()
+		self._flusher = None
+		self._closed = False
+
+	def emit(self, record):
+		"""
+		Add the formatted record to the pending batch, writing the batch if
+		it is full, too old or the record is urgent.
+		"""
+		try:
+			msg = self.format(record) + self.terminator
+			pending = self._pending
+			if not pending:
+				self._pending_since = time.monotonic()
+				if self._flusher is None:
+					self._start_flusher()
+			pending.append(msg)
+			self._pending_size += len(msg)
+			if (self._pending_size >= self.buffer_size or record.levelno >= self.flush_level
+					or time.monotonic() - self._pending_since >= self.flush_interval):
+				self._write_pending()
+		except RecursionError:
+			raise
+		except Exception:
+			self.handleError(record)
+
+	def _write_pending(self):
+		"""
+		Write the pending batch. Must be called with the handler lock held.
+		"""
+		if not self._pending:
+			return
+		data = ''.join(self._pending)
+		self._pending = []
+		self._pending_size = 0
+		self._pending_since = None
+		if self.watch:
+			self.reopenIfNeeded()
+		if self.stream is None:
+			if self.mode != 'w' or not self._closed:
+				self.stream = self._open()
+			else:
+				return
+		stream = self.stream
+		stream.write(data)
+		stream.flush()
+		if self.fsync:
+			os.fsync(stream.fileno())
+
+	def _start_flusher(self):
+		self._flusher = t = threading.Thread(target=self._flush_loop,
+		                                     name='file_flusher')
+		t.daemon = True
+		t.start()
+
+	def _flush_loop(self):
+		"""
+		Write batches which have waited flush_interval seconds.
+		This method runs on a separate, internal thread.
+		"""
+		while not self._closed:
+			since = self._pending_since
+			if since is None:
+				delay = self.flush_interval
+			else:
+				delay = since + self.flush_interval - time.monotonic()
+			if delay > 0:
+				self._wake.wait(delay)
+				continue
+			self.acquire()
+			try:
+				since = self._pending_since
+				if since is not None and time.monotonic() - since >= self.flush_interval:
+					self._write_pending()
+			except Exception:
+				pass
+			finally:
+				self.release()
+
+	def flush(self):
+		"""
+		Write the pending batch, then flush the stream.
+		"""
+		self.acquire()
+		try:
+			self._write_pending()
+			logging.handlers.WatchedFileHandler.flush(self)
+		finally:
+			self.release()
+
+	def close(self):
+		"""
+		Write the pending batch and close the file.
+		"""
+		self.acquire()
+		try:
+			try:
+				self._write_pending()
+			finally:
+				self._closed = True
+				self._wake.set()
+				logging.handlers.WatchedFileHandler.close(self)
+		finally:
+			self.release()
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+	"""
+	A RotatingFileHandler which keeps a running count of the bytes in the
+	current file instead of formatting every record twice to measure it.
+
+	On rollover the file is renamed in one step to a segment name carrying
+	a nanosecond timestamp, and a new file is opened; no other file is
+	touched on the logging thread. A background worker then gzips the
+	segment and removes the oldest segments beyond backupCount.
+	"""
+
+	def __init__(self, filename, mode='a', maxBytes=0, backupCount=0,
+	             encoding=None, delay=False, errors=None, compresslevel=6):
+		logging.handlers.RotatingFileHandler.__init__(self, filename, mode, maxBytes,
+		                                              backupCount, encoding, delay, errors)
+		self.compresslevel = compresslevel
+		self._size = None
+		self._segments = queue.Queue()
+		self._pending = set()
+		self._compressor = None
+
+	def shouldRollover(self, record):
+		"""
+		Not used by emit(), which works from the running byte count; kept
+		for callers of the RotatingFileHandler API.
+		"""
+		return self.maxBytes > 0 and bool(self._size) and self._size >= self.maxBytes
+
+	def emit(self, record):
+		try:
+			msg = self.format(record) + self.terminator
+			if self.stream is None:
+				if self.mode == 'w' and self._closed:
+					return
+				self.stream = self._open()
+			if self._size is None:
+				self.stream.seek(0, 2)
+				self._size = self.stream.tell()
+			size = len(msg.encode(self.stream.encoding, self.stream.errors or 'strict'))
+			if self.maxBytes > 0 and self._size and self._size + size > self.maxBytes:
+				self.doRollover()
+			self.stream.write(msg)
+			self.flush()
+			self._size += size
+		except RecursionError:
+			raise
+		except Exception:
+			self.handleError(record)
+
+	def doRollover(self):
+		"""
+		Rename the current file to a new segment, hand the segment to the
+		compressor and start a new file.
+		"""
+		if self.stream:
+			self.stream.close()
+			self.stream = None
+		if self.backupCount > 0 and os.path.exists(self.baseFilename):
+			segment = self.rotation_filename('%s.%019d' % (self.baseFilename, time.time_ns()))
+			# Marked before it exists, so prune() never sees it unmarked.
+			self._pending.add(segment)
+			os.replace(self.baseFilename, segment)
+			self._segments.put(segment)
+			if self._compressor is None:
+				self._compressor = t = threading.Thread(target=self._compress_loop,
+				                                        name='rotate_compressor')
+				t.daemon = True
+				t.start()
+		if not self.delay:
+			self.stream = self._open()
+		self._size = 0
+
+	def _compress_loop(self):
+		"""
+		Compress rotated segments and prune old ones.
+		This method runs on a separate, internal thread.
+		"""
+		while True:
+			segment = self._segments.get()
+			try:
+				if segment is None:
+					break
+				try:
+					self.compress(segment)
+				finally:
+					self._pending.discard(segment)
+				self.prune()
+			except Exception:
+				logging.getLogger(__name__).exception('Could not compress %s', segment)
+			finally:
+				self._segments.task_done()
+
+	def compress(self, segment):
+		"""
+		Gzip a segment next to itself and remove the original.
+		"""
+		tmp = segment + '.gz.tmp'
+		with open(segment, 'rb') as src, gzip.open(tmp, 'wb', self.compresslevel) as dst:
+			shutil.copyfileobj(src, dst)
+		os.replace(tmp, segment + '.gz')
+		os.remove(segment)
+
+	def segments(self):
+		"""
+		Return the rotated segments of this file, oldest first.
+		"""
+		dirname, basename = os.path.split(self.baseFilename)
+		pattern = re.compile(re.escape(basename) + r'\.\d{19}(\.gz)?$')
+		return sorted(os.path.join(dirname, name) for name in os.listdir(dirname or '.')
+		              if pattern.match(name))
+
+	def prune(self):
+		"""
+		Remove the oldest segments beyond backupCount. Segments still
+		waiting to be compressed are kept, and removed by a later prune()
+		once they are compressed.
+		"""
+		segments = self.segments()
+		excess = len(segments) - self.backupCount
+		for segment in segments:
+			if excess <= 0:
+				break
+			if segment not in self._pending:
+				os.remove(segment)
+				excess -= 1
+
+	def close(self):
+		"""
+		Close the file and wait for segments still being compressed.
+		"""
+		compressor = self._compressor
+		if compressor is not None:
+			self._segments.put(None)
+			compressor.join()
+			self._compressor = None
+		logging.handlers.RotatingFileHandler.close(self)
+
+
+class MmapSegment(object):
+	"""
+	One pre-allocated, memory-mapped segment file of an MmapSegmentHandler.
+	Each record is a 4-byte little-endian length followed by the encoded
+	record. The data is copied in before the length, and the file starts out
+	zero-filled, so a zero length marks the end of the complete records.
+	The file must not exist yet; FileExistsError is raised if it does.
+	"""
+
+	magic = b'MYLOSEG1'
+	header_size = 16
+	_length = struct.Struct('<I')
+
+	def __init__(self, path, size):
+		self.path = path
+		self.size = size
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+		try:
+			os.ftruncate(self.fd, size)
+			self.mm = mmap.mmap(self.fd, size)
+		except Exception:
+			os.close(self.fd)
+			raise
+		self.mm[:len(self.magic)] = self.magic
+		self.offset = self.header_size
+		self.writers = 0
+		self.retired = False
+
+	def close(self):
+		self.mm.close()
+		os.close(self.fd)
+
+	@classmethod
+	def iter_records(cls, path):
+		"""
+		Yield (offset, data) for every complete record in a segment file.
+		"""
+		with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			if mm[:len(cls.magic)] != cls.magic:
+				raise ValueError('%s is not a log segment' % path)
+			offset = cls.header_size
+			unpack_from = cls._length.unpack_from
+			end = len(mm) - cls._length.size
+			while offset <= end:
+				size = unpack_from(mm, offset)[0]
+				if not size:
+					break
+				start = offset + cls._length.size
+				yield offset, mm[start:start + size]
+				offset = start + size
+
+	@classmethod
+	def record_at(cls, path, offset):
+		"""
+		Return the record stored at offset, as yielded by iter_records().
+		"""
+		with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			size = cls._length.unpack_from(mm, offset)[0]
+			if not size:
+				raise ValueError('no record at offset %d of %s' % (offset, path))
+			start = offset + cls._length.size
+			return mm[start:start + size]
+
+
+class MmapSegmentHandler(logging.Handler):
+	"""
+	A handler which appends formatted records, UTF-8 encoded, to a series
+	of pre-allocated memory-mapped segment files in directory, named
+	<prefix>.<number>.seg. A writer reserves its space by bumping the
+	segment offset under a short lock and then copies the record in
+	without holding it; when a segment is full the handler moves on to the
+	next. MmapSegment.iter_records() and record_at() read the segments back.
+	"""
+
+	def __init__(self, directory, prefix='segment', segment_size=16 << 20, level=logging.NOTSET):
+		logging.Handler.__init__(self, level)
+		self.directory = directory
+		self.prefix = prefix
+		self.segment_size = segment_size
+		self.segment = None
+		self._reserve = threading.Lock()
+
+	def segment_path(self, number):
+		return os.path.join(self.directory, '%s.%08d.seg' % (self.prefix, number))
+
+	def segments(self):
+		"""
+		Return the paths of this handler's segments, oldest first.
+		"""
+		pattern = re.compile(re.escape(self.prefix) + r'\.\d{8}\.seg$')
+		return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+		              if pattern.match(name))
+
+	def _next_segment(self):
+		"""
+		Open the segment after the newest one on disk. Must be called with
+		the reserve lock held. Segments are created exclusively, so if
+		another process takes a number first the next free one is used.
+		"""
+		os.makedirs(self.directory, exist_ok=True)
+		old = self.segment
+		if old is None:
+			existing = self.segments()
+			number = int(existing[-1].rsplit('.', 2)[-2]) + 1 if existing else 0
+		else:
+			number = int(old.path.rsplit('.', 2)[-2]) + 1
+			old.retired = True
+			if not old.writers:
+				old.close()
+		while True:
+			try:
+				self.segment = MmapSegment(self.segment_path(number), self.segment_size)
+				return self.segment
+			except FileExistsError:
+				existing = self.segments()
+				newest = int(existing[-1].rsplit('.', 2)[-2]) if existing else number
+				number = max(number, newest) + 1
+
+	def handle(self, record):
+		"""
+		Emit the record if it passes the filters. Unlike Handler.handle the
+		handler lock is not held, as emit() only locks while reserving.
+		"""
+		rv = self.filter(record)
+		if isinstance(rv, logging.LogRecord):
+			record = rv
+		if rv:
+			self.emit(record)
+		return rv
+
+	def emit(self, record):
+		try:
+			data = self.format(record).encode('utf-8')
+			frame = MmapSegment._length.size + len(data)
+			if frame > self.segment_size - MmapSegment.header_size:
+				raise ValueError('record of %d bytes is larger than a segment' % len(data))
+			with self._reserve:
+				segment = self.segment
+				if segment is None or segment.offset + frame > segment.size:
+					segment = self._next_segment()
+				offset = segment.offset
+				segment.offset = offset + frame
+				segment.writers += 1
+			try:
+				start = offset + MmapSegment._length.size
+				segment.mm[start:start + len(data)] = data
+				MmapSegment._length.pack_into(segment.mm, offset, len(data))
+			finally:
+				with self._reserve:
+					segment.writers -= 1
+					if segment.retired and not segment.writers:
+						segment.close()
+		except RecursionError:
+			raise
+		except Exception:
+			self.handleError(record)
+
+	def flush(self):
+		"""
+		Ask the OS to write the current segment's dirty pages to disk.
+		"""
+		with self._reserve:
+			if self.segment is not None:
+				self.segment.mm.flush()
+
+	def close(self):
+		with self._reserve:
+			segment, self.segment = self.segment, None
+			if segment is not None:
+				segment.retired = True
+				if not segment.writers:
+					segment.mm.flush()
+					segment.close()
+		logging.Handler.close(self)
+
+
+class LogStore(object):
+	"""
+	An append-only on-disk store of LogRecords with sparse indexes, used by
+	LogRecordSocketReceiver in storage mode.
+
+	Records are partitioned by creation time into one segment per
+	partition_seconds, <prefix>.<partition start>.seg in directory. They are
+	buffered into blocks of up to block_records, or flush_interval seconds
+	of records, and each block is pickled, compressed and appended to its
+	segment. An entry is then appended to the segment's .idx file giving the
+	block's offset and length, record count, range of created times, range
+	and set of levels, and a small Bloom filter of logger names. A block is
+	always on disk before its entry, so a segment longer than its index
+	after a crash is cut back when it is reopened.
+
+	query() turns the top-level conditions of an eValuation.Evaluator
+	expression on created, levelno, levelname and name into partition and
+	block pruning, reads only the blocks which can hold matches and then
+	evaluates the whole expression on each of their records, e.g.
+
+	store.query("levelname == 'ERROR' and name == 'Users Log'", since=600)
+	"""
+
+	# offset, length, count, first and last created, min and max levelno,
+	# levelno bitmask, logger name Bloom filter
+	_entry = struct.Struct('<QIIddHHQ16s')
+	_bloom_bits = 128
+
+	def __init__(self, directory, prefix='records', partition_seconds=3600, block_records=512,
+	             flush_interval=1.0, compresslevel=1, open_partitions=2):
+		self.directory = directory
+		self.prefix = prefix
+		self.partition_seconds = partition_seconds
+		self.block_records = block_records
+		self.flush_interval = flush_interval
+		self.compresslevel = compresslevel
+		self.open_partitions = open_partitions
+		self.lock = threading.Lock()
+		self.planner = PredicateIndex()
+		self._pending = {}
+		self._pending_since = None
+		self._open = collections.OrderedDict()
+		self._indexes = {}
+		os.makedirs(directory, exist_ok=True)
+
+	def partition_of(self, created):
+		return int(created // self.partition_seconds) * self.partition_seconds
+
+	def segment_path(self, partition):
+		return os.path.join(self.directory, '%s.%012d.seg' % (self.prefix, partition))
+
+	def partitions(self):
+		"""
+		Return the start times of the partitions on disk, oldest first.
+		"""
+		pattern = re.compile(re.escape(self.prefix) + r'\.(\d{12})\.seg$')
+		found = set()
+		for name in os.listdir(self.directory):
+			match = pattern.match(name)
+			if match:
+				found.add(int(match.group(1)))
+		return sorted(found)
+
+	def append(self, record):
+		"""
+		Add a record to the block being built for its partition. The message
+		is merged with its arguments and exc_info dropped, as for pickling.
+		"""
+		attrs = dict(record.__dict__)
+		attrs['msg'] = record.getMessage()
+		attrs['args'] = None
+		attrs['exc_info'] = None
+		partition = self.partition_of(attrs['created'])
+		now = time.monotonic()
+		with self.lock:
+			block = self._pending.setdefault(partition, [])
+			block.append(attrs)
+			if self._pending_since is None:
+				self._pending_since = now
+			if len(block) >= self.block_records:
+				self._write_block(partition)
+			elif now - self._pending_since >= self.flush_interval:
+				self._write_pending()
+
+	def flush(self):
+		"""
+		Write every buffered block.
+		"""
+		with self.lock:
+			self._write_pending()
+
+	def _write_pending(self):
+		for partition in list(self._pending):
+			self._write_block(partition)
+		self._pending_since = None
+
+	@classmethod
+	def _name_bits(cls, name):
+		data = name.encode('utf-8', 'surrogateescape')
+		return (1 << (zlib.crc32(data) % cls._bloom_bits)) | (1 << (zlib.adler32(data) % cls._bloom_bits))
+
+	def _write_block(self, partition):
+		"""
+		Append the partition's buffered records as one block, then its index
+		entry. Must be called with the lock held.
+		"""
+		records = self._pending.pop(partition, None)
+		if not records:
+			return
+		data = zlib.compress(pickle.dumps(records, pickle.HIGHEST_PROTOCOL), self.compresslevel)
+		created = [attrs['created'] for attrs in records]
+		levels = set(attrs.get('levelno', 0) for attrs in records)
+		mask = 0
+		for level in levels:
+			mask |= 1 << min(max(level, 0), 63)
+		bloom = 0
+		for name in set(attrs.get('name', '') for attrs in records):
+			bloom |= self._name_bits(name)
+		seg, idx, offset = self._segment(partition)
+		entry = (offset, len(data), len(records), min(created), max(created),
+		         min(min(levels), 0xFFFF), min(max(levels), 0xFFFF), mask,
+		         bloom.to_bytes(16, 'little'))
+		written = 0
+		while written < len(data):
+			written += os.pwrite(seg, data[written:], offset + written)
+		os.write(idx, self._entry.pack(*entry))
+		self._open[partition] = (seg, idx, offset + len(data))
+		index = self._indexes.get(partition)
+		if index is not None:
+			index[1].append(entry)
+			index[0] += self._entry.size
+
+	def _segment(self, partition):
+		"""
+		Return (segment fd, index fd, end of data) for a partition, opening
+		it if needed and closing the least recently used partition beyond
+		open_partitions. Must be called with the lock held.
+		"""
+		try:
+			self._open.move_to_end(partition)
+			return self._open[partition]
+		except KeyError:
+			pass
+		path = self.segment_path(partition)
+		seg = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		idx = os.open(path[:-4] + '.idx', os.O_RDWR | os.O_CREAT, 0o644)
+		entries = self._read_index(idx)
+		# Drop a torn index entry and any block data it does not describe.
+		os.ftruncate(idx, len(entries) * self._entry.size)
+		os.lseek(idx, 0, os.SEEK_END)
+		end = entries[-1][0] + entries[-1][1] if entries else 0
+		if os.fstat(seg).st_size > end:
+			os.ftruncate(seg, end)
+		self._open[partition] = opened = (seg, idx, end)
+		while len(self._open) > self.open_partitions:
+			old_seg, old_idx, old_end = self._open.popitem(last=False)[1]
+			os.close(old_seg)
+			os.close(old_idx)
+		return opened
+
+	def _read_index(self, fd, start=0):
+		size = os.fstat(fd).st_size
+		length = (size - start) // self._entry.size * self._entry.size
+		data = os.pread(fd, length, start) if length > 0 else b''
+		return list(self._entry.iter_unpack(data))
+
+	def index(self, partition):
+		"""
+		Return the index entries of a partition, reading only what was added
+		to its .idx since the last call.
+		"""
+		with self.lock:
+			return list(self._index(partition))
+
+	def _index(self, partition):
+		# The cache is also extended by _write_block, so the lock must be held.
+		path = self.segment_path(partition)[:-4] + '.idx'
+		cached = self._indexes.get(partition)
+		try:
+			fd = os.open(path, os.O_RDONLY)
+		except FileNotFoundError:
+			return []
+		try:
+			if cached is None:
+				entries = self._read_index(fd)
+				cached = self._indexes[partition] = [len(entries) * self._entry.size, entries]
+			elif os.fstat(fd).st_size > cached[0]:
+				entries = self._read_index(fd, cached[0])
+				cached[1].extend(entries)
+				cached[0] += len(entries) * self._entry.size
+		finally:
+			os.close(fd)
+		return cached[1]
+
+	def plan(self, where=None, start=None, end=None):
+		"""
+		Work out the bounds query() prunes with: a created range, a levelno
+		range, a set of levels and a set of logger names, each None when
+		unconstrained.
+		"""
+		plan = {'start': start, 'end': end, 'low': None, 'high': None, 'levels': None, 'names': None}
+		if where is None:
+			return plan
+		node = self.planner.evaluator.parse(where).body
+
+		def narrow(key, values):
+			plan[key] = values if plan[key] is None else plan[key] & values
+
+		for attr, op, value in self.planner.conditions(node):
+			values = value if op == 'in' else frozenset((value,))
+			if attr == 'created' and isinstance(value, (int, float)):
+				if op in ('gt', 'gte', 'eq'):
+					plan['start'] = value if plan['start'] is None else max(plan['start'], value)
+				if op in ('lt', 'lte', 'eq'):
+					plan['end'] = value if plan['end'] is None else min(plan['end'], value)
+			elif attr == 'levelno':
+				if op in ('eq', 'in'):
+					if all(isinstance(v, int) for v in values):
+						narrow('levels', frozenset(values))
+				elif isinstance(value, (int, float)):
+					if op in ('gt', 'gte'):
+						plan['low'] = value if plan['low'] is None else max(plan['low'], value)
+					else:
+						plan['high'] = value if plan['high'] is None else min(plan['high'], value)
+			elif attr == 'levelname' and op in ('eq', 'in'):
+				levels = [logging._nameToLevel.get(v) for v in values]
+				if None not in levels:
+					narrow('levels', frozenset(levels))
+			elif attr == 'name' and op in ('eq', 'in'):
+				if all(isinstance(v, str) for v in values):
+					narrow('names', frozenset(values))
+		return plan
+
+	def _block_may_match(self, entry, plan, mask, blooms):
+		offset, length, count, first, last, lowest, highest, levels, bloom = entry
+		if plan['start'] is not None and last < plan['start']:
+			return False
+		if plan['end'] is not None and first > plan['end']:
+			return False
+		if plan['low'] is not None and highest < plan['low']:
+			return False
+		if plan['high'] is not None and lowest > plan['high']:
+			return False
+		if mask is not None and not levels & mask:
+			return False
+		if blooms is not None:
+			bloom = int.from_bytes(bloom, 'little')
+			return any(bloom & bits == bits for bits in blooms)
+		return True
+
+	def query(self, where=None, start=None, end=None, since=None, limit=None):
+		"""
+		Yield the stored records matching where, an Evaluator expression
+		over record attributes, and created between start and end (epoch
+		seconds), or within the last since seconds. Partitions are read
+		oldest first, records in the order they were stored, then records
+		still buffered. A record on which where raises does not match.
+		"""
+		if since is not None:
+			start = time.time() - since if start is None else max(start, time.time() - since)
+		plan = self.plan(where, start, end)
+		compiled = None
+		if where is not None:
+			compiled = self.planner.evaluator.compile(where)
+		mask = None
+		if plan['levels'] is not None:
+			mask = 0
+			for level in plan['levels']:
+				mask |= 1 << min(max(level, 0), 63)
+		blooms = None
+		if plan['names'] is not None:
+			blooms = [self._name_bits(name) for name in plan['names']]
+		start, end = plan['start'], plan['end']
+
+		def matches(attrs):
+			created = attrs['created']
+			if (start is not None and created < start) or (end is not None and created > end):
+				return False
+			if compiled is None:
+				return True
+			try:
+				return compiled(attrs)
+			except Exception:
+				return False
+
+		# Take the buffered records and the index together, so a block
+		# written meanwhile is seen in exactly one of them.
+		with self.lock:
+			pending = dict((partition, list(block)) for partition, block in self._pending.items())
+			indexes = {}
+			for partition in sorted(set(self.partitions()) | set(pending)):
+				if start is not None and partition + self.partition_seconds <= start:
+					continue
+				if end is not None and partition > end:
+					continue
+				indexes[partition] = list(self._index(partition))
+		found = 0
+		for partition, index in indexes.items():
+			blocks = [entry for entry in index
+			          if self._block_may_match(entry, plan, mask, blooms)]
+			chunks = []
+			if blocks:
+				fd = os.open(self.segment_path(partition), os.O_RDONLY)
+				try:
+					for entry in blocks:
+						chunks.append(pickle.loads(zlib.decompress(os.pread(fd, entry[1], entry[0]))))
+				finally:
+					os.close(fd)
+			chunks.append(pending.get(partition, ()))
+			for records in chunks:
+				for attrs in records:
+					if matches(attrs):
+						yield logging.makeLogRecord(attrs)
+						found += 1
+						if limit is not None and found >= limit:
+							return
+
+	def prune(self, before):
+		"""
+		Delete the partitions which end before the given epoch time.
+		"""
+		with self.lock:
+			for partition in self.partitions():
+				if partition + self.partition_seconds > before:
+					continue
+				opened = self._open.pop(partition, None)
+				if opened is not None:
+					os.close(opened[0])
+					os.close(opened[1])
+				self._indexes.pop(partition, None)
+				path = self.segment_path(partition)
+				for name in (path, path[:-4] + '.idx'):
+					try:
+						os.remove(name)
+					except FileNotFoundError:
+						pass
+
+	def close(self):
+		with self.lock:
+			self._write_pending()
+			while self._open:
+				seg, idx, end = self._open.popitem()[1]
+				os.close(seg)
+				os.close(idx)
+
+
+class LazyHandler(logging.Handler):
+	"""
+	A stand-in for a handler which is only constructed, by calling
+	factory(*args, **kwargs), when the first record reaches it. Files,
+	sockets and /dev/log are then only opened by processes which log to
+	them.
+
+	Level, formatter, filters and name set on the stand-in are passed on to
+	the real handler, which does all of the filtering and emitting.
+	"""
+
+	def __init__(self, factory, *args, **kwargs):
+		logging.Handler.__init__(self)
+		self.factory = factory
+		self.args = args
+		self.kwargs = kwargs
+		self.target = None
+
+	@property
+	def handler(self):
+		"""
+		The real handler, constructed on first use.
+		"""
+		target = self.target
+		if target is None:
+			with self.lock:
+				target = self.target
+				if target is None:
+					target = self.factory(*self.args, **self.kwargs)
+					target.setLevel(self.level)
+					if self.formatter is not None:
+						target.setFormatter(self.formatter)
+					for f in self.filters:
+						target.addFilter(f)
+					if self.name and not target.name:
+						target.name = self.name
+					if 'handleError' in self.__dict__:
+						# Keep an instance override, such as ListenerMetrics'
+						target.handleError = self.handleError
+					self.target = target
+		return target
+
+	def setLevel(self, level):
+		logging.Handler.setLevel(self, level)
+		if self.target is not None:
+			self.target.setLevel(level)
+
+	def setFormatter(self, fmt):
+		logging.Handler.setFormatter(self, fmt)
+		if self.target is not None:
+			self.target.setFormatter(fmt)
+
+	def addFilter(self, filter):
+		logging.Handler.addFilter(self, filter)
+		if self.target is not None:
+			self.target.addFilter(filter)
+
+	def removeFilter(self, filter):
+		logging.Handler.removeFilter(self, filter)
+		if self.target is not None:
+			self.target.removeFilter(filter)
+
+	def handle(self, record):
+		return self.handler.handle(record)
+
+	def emit(self, record):
+		self.handler.emit(record)
+
+	def flush(self):
+		if self.target is not None:
+			self.target.flush()
+
+	def close(self):
+		if self.target is not None:
+			self.target.close()
+		logging.Handler.close(self)
+
+	def __repr__(self):
+		target = self.target
+		if target is None:
+			name = getattr(self.factory, '__name__', repr(self.factory))
+			return '<%s %s (not created)>' % (self.__class__.__name__, name)
+		return '<%s %r>' % (self.__class__.__name__, target)
+
+
+class SyslogBOMFormatter(CompiledFormatter):
+	def format(self, record):
+		result = super().format(record)
+		return result
+
+
+class OneLineExceptionFormatter(logging.Formatter):
+	def formatException(self, exc_info):
+		result = super().formatException(exc_info)
+		return repr(result)
+
+	def format(self, record):
+		result = super().format(record)
+		if record.exc_text:
+			result = result.replace("\n", "")
+		return result
+
+
+class ContextFilter(logging.Filter):
+
+	def __init__(self, userslist, ipslist, hostslist):
+		logging.Filter.__init__(self)
+		self.users = userslist
+		self.ips = ipslist
+		self.hosts = hostslist
+
+	def filter(self, record):
+		record.ip = self.ips
+		record.user = self.users
+		record.host = self.hosts
+		return True
+
+
+class LogContext(object):
+	"""
+	Context values stamped onto every LogRecord when it is created.
+
+	install() wraps the LogRecord factory, so the values are set once per
+	record for every logger instead of by a filter on each one. The values
+	live in a contextvars.ContextVar: each asyncio task sees the values
+	bound where it was created, and wrap() or submit() carry them into
+	thread pool workers, which otherwise start with an empty context.
+
+	Only the keys bound in the current context are set on the record, so
+	extra= can still carry any key which is not bound. A formatter fills in
+	the defaults for the rest, as build_logging's User_Info does by passing
+	defaults to CompiledFormatter.
+	"""
+
+	# Bound keys may not replace what the record itself carries, the same
+	# rule Logger.makeRecord applies to extra.
+	reserved = frozenset(logging.makeLogRecord({}).__dict__) | frozenset(('message', 'asctime'))
+
+	def __init__(self, **defaults):
+		self.defaults = {'user': '-', 'ip': '-', 'host': '-'}
+		self.defaults.update(defaults)
+		self.values = contextvars.ContextVar('LogContext-%x' % id(self), default=None)
+		self.factory = None
+
+	def register(self, key, default='-'):
+		self.defaults[key] = default
+
+	def get(self):
+		values = dict(self.defaults)
+		values.update(self.values.get() or {})
+		return values
+
+	def set(self, **values):
+		"""
+		Bind values in the current context and return a token for reset().
+		Raises KeyError for a key which is a LogRecord attribute.
+		"""
+		for key in values:
+			if key in self.reserved:
+				raise KeyError('Attempt to overwrite %r in LogRecord' % key)
+			if key not in self.defaults:
+				self.register(key)
+		current = self.values.get()
+		if current:
+			values = dict(current, **values)
+		return self.values.set(values)
+
+	def reset(self, token):
+		self.values.reset(token)
+
+	def bind(self, **values):
+		return LogContextBinding(self, values)
+
+	def wrap(self, func):
+		"""
+		Return func bound to a copy of the current context, for handing
+		to threads and executors.
+		"""
+		context = contextvars.copy_context()
+
+		@functools.wraps(func)
+		def run(*args, **kwargs):
+			return context.run(func, *args, **kwargs)
+
+		return run
+
+	def submit(self, executor, func, *args, **kwargs):
+		return executor.submit(self.wrap(func), *args, **kwargs)
+
+	def install(self):
+		if self.factory is not None:
+			return self
+		factory = self.factory = logging.getLogRecordFactory()
+		values = self.values
+
+		def make_record(*args, **kwargs):
+			record = factory(*args, **kwargs)
+			bound = values.get()
+			if bound:
+				record.__dict__.update(bound)
+			return record
+
+		self.record_factory = make_record
+		logging.setLogRecordFactory(make_record)
+		return self
+
+	def uninstall(self):
+		if self.factory is None:
+			return
+		if logging.getLogRecordFactory() is self.record_factory:
+			logging.setLogRecordFactory(self.factory)
+		self.factory = None
+
+
+class LogContextBinding(object):
+	def __init__(self, context, values):
+		self.context = context
+		self.values = values
+
+	def __enter__(self):
+		self.token = self.context.set(**self.values)
+		return self.context
+
+	def __exit__(self, et, ev, tb):
+		self.context.reset(self.token)
+
+
+class RateLimitFilter(logging.Filter):
+	"""
+	Suppress floods of records from hot loops.
+
+	Each record takes a token from a bucket for its logger and one for its
+	call site (pathname and line); buckets refill at rate tokens per second
+	up to burst. Records with the same logger, message template and level
+	are also collapsed: the first in each window of window seconds passes
+	and the rest are counted. When a window with suppressed records ends,
+	one summary record saying how many times the message repeated is sent
+	to target, which defaults to the record's logger.
+
+	Added to a CustomQueueHandler it runs before prepare(), so suppressed
+	records are never formatted or pickled. Records at or above
+	exempt_level always pass.
+	"""
+
+	def __init__(self, rate=10.0, burst=20, window=1.0, per_logger=True, per_site=True,
+	             dedupe=True, exempt_level=None, target=None, name=''):
+		logging.Filter.__init__(self, name)
+		self.rate = rate
+		self.burst = burst
+		self.window = window
+		self.per_logger = per_logger
+		self.per_site = per_site
+		self.dedupe = dedupe
+		self.exempt_level = exempt_level
+		self.target = target
+		self.lock = threading.Lock()
+		self._buckets = {}
+		self._windows = {}
+		self._sweep_wake = threading.Event()
+		self._sweep_thread = None
+		self._closed = False
+
+	def attach(self, target):
+		"""
+		Add this filter to a handler or logger, which also receives the
+		summary records.
+		"""
+		self.target = target
+		target.addFilter(self)
+		return target
+
+	def filter(self, record):
+		if getattr(record, 'repeated', None) is not None:
+			return True
+		if self.exempt_level is not None and record.levelno >= self.exempt_level:
+			return True
+		if self.nlen and not logging.Filter.filter(self, record):
+			return True
+		msg = record.msg
+		if isinstance(msg, Message):
+			msg = msg.fmt
+		try:
+			key = (record.name, msg, record.levelno)
+			hash(key)
+		except TypeError:
+			key = (record.name, repr(msg), record.levelno)
+		now = time.monotonic()
+		expired = None
+		with self.lock:
+			entry = self._windows.get(key)
+			if entry is not None and entry[0] <= now:
+				expired = self._windows.pop(key)
+				entry = None
+			if entry is None:
+				entry = self._windows[key] = [now + self.window, 0, None]
+				allowed = self._take(record, now)
+			elif self.dedupe:
+				allowed = False
+			else:
+				allowed = self._take(record, now)
+			if not allowed:
+				entry[1] += 1
+				entry[2] = record
+			if self._sweep_thread is None:
+				self._start_sweep()
+		if expired is not None and expired[1]:
+			self.emitSummary(expired[2], expired[1])
+		return allowed
+
+	def _take(self, record, now):
+		"""
+		Take a token from each of the record's buckets if all of them have
+		one. Must be called with the lock held.
+		"""
+		if self.rate is None:
+			return True
+		buckets = []
+		if self.per_logger:
+			buckets.append(self._bucket(record.name, now))
+		if self.per_site:
+			buckets.append(self._bucket((record.pathname, record.lineno), now))
+		for bucket in buckets:
+			if bucket[0] < 1:
+				return False
+		for bucket in buckets:
+			bucket[0] -= 1
+		return True
+
+	def _bucket(self, key, now):
+		bucket = self._buckets.get(key)
+		if bucket is None:
+			bucket = self._buckets[key] = [self.burst, now]
+		else:
+			bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+			bucket[1] = now
+		return bucket
+
+	def makeSummary(self, record, count):
+		summary = logging.makeLogRecord(record.__dict__)
+		summary.msg = '%s (repeated %d times in %.3gs)'
+		summary.args = (record.getMessage(), count, self.window)
+		summary.exc_info = None
+		summary.exc_text = None
+		summary.repeated = count
+		return summary
+
+	def emitSummary(self, record, count):
+		target = self.target
+		if target is None:
+			target = logging.getLogger(record.name)
+		target.handle(self.makeSummary(record, count))
+
+	def flush(self, force=False):
+		"""
+		End expired windows, or all of them if force is true, sending a
+		summary for each one with suppressed records.
+		"""
+		now = time.monotonic()
+		with self.lock:
+			windows = self._windows
+			if force:
+				expired = list(windows.values())
+				windows.clear()
+			else:
+				expired = [windows.pop(key) for key, entry in list(windows.items())
+				           if entry[0] <= now]
+			if force or len(self._buckets) > 4096:
+				self._buckets = {key: bucket for key, bucket in self._buckets.items()
+				                 if bucket[0] < self.burst}
+		for entry in expired:
+			if entry[1]:
+				self.emitSummary(entry[2], entry[1])
+
+	def _start_sweep(self):
+		self._sweep_thread = t = threading.Thread(target=self._sweep, name='ratelimit_sweep')
+		t.daemon = True
+		t.start()
+
+	def _sweep(self):
+		"""
+		Send the summaries of windows which have ended, so a burst that stops
+		is still reported. This method runs on a separate, internal thread.
+		"""
+		while not self._closed:
+			self._sweep_wake.wait(self.window)
+			if self._closed:
+				break
+			try:
+				self.flush()
+			except Exception:
+				pass
+
+	def close(self):
+		"""
+		Send the summaries of all open windows and stop the sweep thread.
+		"""
+		self._closed = True
+		self._sweep_wake.set()
+		self.flush(force=True)
+
+
+class PredicateIndex(object):
+	"""
+	A set of eValuation.Evaluator expressions over LogRecord attributes,
+	indexed so that a record is only tested against the rules it could
+	match.
+
+	Each rule is filed under one of its top-level conditions: an equality
+	or "in" test of an attribute against constants if it has one, otherwise
+	a range test such as levelno >= 30. A record picks up the rules filed
+	under its own attribute values and the range rules whose bounds it
+	satisfies; rules with no such condition are always tested. Candidates
+	are then evaluated in full, so the index only has to be a superset.
+	"""
+
+	_flipped = {'eq': 'eq', 'lt': 'gt', 'lte': 'gte', 'gt': 'lt', 'gte': 'lte'}
+	_missing = object()
+
+	def __init__(self, expressions=()):
+		self.evaluator = eVal.Evaluator()
+		self.rules = {}
+		for expression in expressions:
+			self.add(expression)
+		self._rebuild()
+
+	def add(self, expression, key=None):
+		"""
+		Add a rule; match() yields key, or the expression itself, when the
+		rule matches a record.
+		"""
+		node = self.evaluator.parse(expression)
+		compiled = self.evaluator.compile_node(node)
+		self.rules[expression] = (compiled, expression if key is None else key,
+		                          self.index_condition(node.body))
+		self._rebuild()
+
+	def remove(self, expression):
+		del self.rules[expression]
+		self._rebuild()
+
+	def conditions(self, node):
+		"""
+		Yield (attribute, op, constant) for each simple comparison among the
+		top-level conjuncts of node, op being 'eq', 'in', 'lt', 'lte', 'gt'
+		or 'gte' with the attribute on the left.
+		"""
+		conjuncts = node.values if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And) else [node]
+		for conjunct in conjuncts:
+			if not isinstance(conjunct, ast.Compare):
+				continue
+			left = conjunct.left
+			for op, right in zip(conjunct.ops, conjunct.comparators):
+				op_name = op.__class__.__name__.lower()
+				if isinstance(left, ast.Name) and left.id not in self.evaluator.builtin_names:
+					attr, other, flip = left.id, right, False
+				elif isinstance(right, ast.Name) and right.id not in self.evaluator.builtin_names:
+					attr, other, flip = right.id, left, True
+				else:
+					left = right
+					continue
+				left = right
+				try:
+					value = ast.literal_eval(other)
+				except ValueError:
+					continue
+				if op_name == 'in' and not flip:
+					try:
+						values = frozenset(value)
+					except TypeError:
+						continue
+					yield attr, 'in', values
+				elif op_name in self._flipped:
+					try:
+						hash(value)
+					except TypeError:
+						continue
+					yield attr, self._flipped[op_name] if flip else op_name, value
+
+	def index_condition(self, node):
+		"""
+		Choose the condition a rule is filed under: equality first, then a
+		range, or None if the rule has to be tested against every record.
+		"""
+		ranges = []
+		for attr, op, value in self.conditions(node):
+			if op in ('eq', 'in'):
+				return attr, op, value
+			ranges.append((attr, op, value))
+		return ranges[0] if ranges else None
+
+	def _rebuild(self):
+		self._always = []
+		self._equal = {}
+		lower = {}
+		upper = {}
+		for compiled, key, condition in self.rules.values():
+			rule = (compiled, key)
+			if condition is None:
+				self._always.append(rule)
+				continue
+			attr, op, value = condition
+			if op in ('eq', 'in'):
+				table = self._equal.setdefault(attr, {})
+				for v in (value if op == 'in' else (value,)):
+					table.setdefault(v, []).append(rule)
+			else:
+				bounds = lower if op in ('gt', 'gte') else upper
+				bounds.setdefault(attr, []).append((value, rule))
+		self._lower = {}
+		self._upper = {}
+		for source, target in ((lower, self._lower), (upper, self._upper)):
+			for attr, entries in source.items():
+				try:
+					entries.sort(key=lambda entry: entry[0])
+				except TypeError:
+					# Bounds of mixed types cannot be ordered; test them all.
+					self._always.extend(rule for value, rule in entries)
+					continue
+				target[attr] = ([value for value, rule in entries],
+				                [rule for value, rule in entries])
+
+	def candidates(self, record):
+		"""
+		Yield the (compiled, key) rules which could match the record.
+		"""
+		attrs = record.__dict__
+		missing = self._missing
+		yield from self._always
+		for attr, table in self._equal.items():
+			value = attrs.get(attr, missing)
+			if value is missing:
+				continue
+			try:
+				rules = table.get(value)
+			except TypeError:
+				continue
+			if rules:
+				yield from rules
+		for attr, (bounds, rules) in self._lower.items():
+			value = attrs.get(attr, missing)
+			if value is missing:
+				continue
+			try:
+				yield from rules[:bisect.bisect_right(bounds, value)]
+			except TypeError:
+				yield from rules
+		for attr, (bounds, rules) in self._upper.items():
+			value = attrs.get(attr, missing)
+			if value is missing:
+				continue
+			try:
+				yield from rules[bisect.bisect_left(bounds, value):]
+			except TypeError:
+				yield from rules
+
+	def match(self, record):
+		"""
+		Yield the key of every rule the record matches. A rule which raises,
+		for instance on an attribute the record lacks, does not match.
+		"""
+		attrs = record.__dict__
+		for compiled, key in self.candidates(record):
+			try:
+				if compiled(attrs):
+					yield key
+			except Exception:
+				pass
+
+
+class ExpressionFilter(logging.Filter):
+	"""
+	A filter which passes records matching any of its expressions, written
+	in the eValuation.Evaluator language over record attributes, e.g.
+
+	levelno >= 30 and name in ('Main Log', 'Users Log')
+
+	The rules are kept in a PredicateIndex, which may be shared with
+	other code through the index argument.
+	"""
+
+	def __init__(self, *expressions, index=None, name=''):
+		logging.Filter.__init__(self, name)
+		self.index = PredicateIndex() if index is None else index
+		for expression in expressions:
+			self.index.add(expression)
+
+	def addRule(self, expression):
+		self.index.add(expression)
+
+	def removeRule(self, expression):
+		self.index.remove(expression)
+
+	def filter(self, record):
+		if not logging.Filter.filter(self, record):
+			return False
+		for key in self.index.match(record):
+			return True
+		return False
+
+
+class LoggingContext(object):
+	def __init__(self, logger, level=None, handler=None, close=True):
+		self.logger = logger
+		self.level = level
+		self.handler = handler
+		self.close = close
+
+	def __enter__(self):
+		if self.level is not None:
+			self.old_level = self.logger.level
+			self.logger.setLevel(self.level)
+		if self.handler:
+			self.logger.addHandler(self.handler)
+
+	def __exit__(self, et, ev, tb):
+		if self.level is not None:
+			self.logger.setLevel(self.old_level)
+		if self.handler:
+			self.logger.removeHandler(self.handler)
+		if self.handler and self.close:
+			self.handler.close()
+
+
+class Log_Server():
+	def start_log_server(self, port, mylo=None):
+		# read initial config file
+		# logging.config.fileConfig('logging.conf')
+		# create and start listener on port
+		# with a MyloLogging, pushed configs are applied incrementally
+		import logging.config
+		print('Log Server Started')
+		verify = mylo.verifyConfig if mylo is not None else None
+		self.t = logging.config.listen(port, verify)
+		self.t.start()
+		logger = logging.getLogger('log server log')
+
+	def stop_log_server(self):
+		# cleanup
+		import logging.config
+		print('Log Server Stopped')
+		logging.config.stopListening()
+		self.t.join()
+
+
+class Message(object):
+	def __init__(self, fmt, args):
+		self.fmt = fmt
+		self.args = args
+		self.text = None
+
+	def __str__(self):
+		# Formatted on first use only; every handler sees the same text.
+		if self.text is None:
+			self.text = self.fmt.format(*self.args)
+		return self.text
+
+
+class StyleAdapter(logging.LoggerAdapter):
+	def __init__(self, logger, extra=None):
+		super(StyleAdapter, self).__init__(logger, extra or {})
+
+	def log(self, level, msg, *args, **kwargs):
+		if self.isEnabledFor(level):
+			msg, kwargs = self.process(msg, kwargs)
+			self.logger._log(level, Message(msg, args), (), **kwargs)
+
+
+class CustomAdapter(logging.LoggerAdapter):
+	def process(self, msg, kwargs):
+		return '[%s] %s' % (self.extra['connid'], msg), kwargs
 
 
 class setListeningPort():
-	def __init__(self, port):
-		lp = logging.config.listen(port)
+	def __init__(self, port, mylo=None):
+		import logging.config
+		lp = logging.config.listen(port, mylo.verifyConfig if mylo is not None else None)
 		lp.start()
 